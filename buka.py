@@ -30,8 +30,18 @@ import shutil
 import argparse
 import time
 import json
+import stat
 import struct
+import hashlib
+import mmap
 import sqlite3
+import zipfile
+import threading
+import socketserver
+import http.server
+import select
+import signal
+import ctypes, ctypes.util
 import urllib.request, urllib.parse
 import logging, logging.config
 import traceback
@@ -40,6 +50,8 @@ from io import StringIO, BytesIO
 from collections import OrderedDict, deque
 from subprocess import Popen, PIPE
 from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from array import array
 
 try:
 	# requires Pillow with WebP support
@@ -47,13 +59,36 @@ try:
 	import PIL.WebPImagePlugin
 	SUPPORTPIL = True
 	# release 2.8.0 fixed webp decode memory leak
-	PILFIXED = tuple(map(int, (Image.PILLOW_VERSION.split(".")[:2]))) > (2, 7)
+	# PILLOW_VERSION is removed in Pillow 9
+	PILFIXED = tuple(map(int, (getattr(Image, '__version__', getattr(Image, 'PILLOW_VERSION', '0.0')).split(".")[:2]))) > (2, 7)
 except ImportError:
 	SUPPORTPIL = False
 	PILFIXED = False
 
+try:
+	# for reflinks on Linux
+	import fcntl
+except ImportError:
+	fcntl = None
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+try:
+	# Python 3.8+
+	from multiprocessing import shared_memory
+except ImportError:
+	shared_memory = None
+
 NT_SLEEP_SEC = 7
 logstr = StringIO()
+_imgfiletype = frozenset(('jpg', 'png', 'webp', 'gif'))
+# files copied to/used from the input folder, others are ignored
+_copytype = frozenset(('index2', 'chaporder', 'buka', 'bup', 'jpg', 'png', 'sqlite3')) # ,'webp'
+# {comicid: (size, mtime_ns, content, chaporder, chapids)} of the last
+# COMICINFO_CACHE_SIZE comics, see cachedcomicinfo
+_comicinfocache = OrderedDict()
+_comicinfolock = threading.Lock()
+COMICINFO_CACHE_SIZE = 32
 
 class BadBukaFile(Exception):
 	pass
@@ -124,42 +159,46 @@ class tTree():
 		return repr(self.d)
 
 class BukaFile:
-	'''Reads the buka file.'''
-	def __init__(self, filename):
+	'''
+	Reads the buka file.
+
+	If usemmap is True, the archive is memory-mapped and the entries are
+	returned as memoryview slices into the map instead of bytes copies.
+	'''
+	def __init__(self, filename, usemmap=False):
 		self.filename = filename
+		self.mm = self._view = None
+		# see sequential()
+		self.chunksize = 0
+		self._chunk = (0, b'')
 		f = self.fp = open(filename, 'rb')
 		buff = f.read(128)
 		if buff[0:4] != b'buka':
 			raise BadBukaFile('not a buka file')
-		# I guess it's the version number.
-		# [4:8] is more likely a (minor) version
-		# [9:12] may be a major version or "file type"
-		self.version = struct.unpack('<II', buff[4:12])
-		self.comicid = struct.unpack('<I', buff[12:16])[0]
-		self.chapid = struct.unpack('<I', buff[16:20])[0]
-		pos = buff.find(b'\x00', 20)
-		self.comicname = buff[20:pos].decode(encoding='utf-8', errors='ignore')
-		pos += 1
-		endhead = pos + struct.unpack('<I', buff[pos:pos + 4])[0] - 1
-		pos += 4
+		if usemmap:
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			self._view = memoryview(self.mm)
+		self.version, self.comicid, self.chapid, self.comicname, pos, endhead = parsehead(buff)
 		f.seek(pos)
-		buff = f.read(endhead-pos+1)
-		self.files = OrderedDict() # {}
-		pos = 0
-		while pos + 8 < len(buff):
-			pointer, size = struct.unpack('<II', buff[pos:pos + 8])
-			pos += 8
-			end = buff.find(b'\x00', pos)
-			name = buff[pos:end].decode(encoding='utf-8', errors='ignore')
-			pos = end + 1
-			self.files[name] = (pointer, size)
-		if 'chaporder.dat' in self.files:
-			self.fp.seek(self.files['chaporder.dat'][0])
-			self._chaporderdat = self.fp.read(self.files['chaporder.dat'][1])
-			self.chapinfo = ComicInfo(json.loads(self._chaporderdat.decode('utf-8')), self.comicid)
-		else:
-			self._chaporderdat, self.chapinfo = None, None
+		self.files = parsetoc(f.read(endhead-pos+1))
+		self.mtime = os.fstat(f.fileno()).st_mtime_ns
+		self._chaporderdat = None
+		self._chapinfo = False
+
+	@property
+	def chapinfo(self):
+		'''The ComicInfo from the embedded chaporder.dat, parsed on first use.'''
+		if self._chapinfo is False:
+			if 'chaporder.dat' in self.files:
+				self._chapinfo = cachedcomicinfo(self.comicid, self.chapid,
+					self.files['chaporder.dat'][1], self.mtime, self._readchaporder)
+			else:
+				self._chapinfo = None
+		return self._chapinfo
 
+	def _readchaporder(self):
+		self._chaporderdat = bytes(self.getfile('chaporder.dat'))
+		return self._chaporderdat
 
 	def __len__(self):
 		return len(self.files)
@@ -169,6 +208,8 @@ class BukaFile:
 			if key == 'chaporder.dat' and self._chaporderdat:
 				return self._chaporderdat
 			index = self.files[key]
+			if self._view is not None:
+				return self._view[index[0]:index[0] + index[1]]
 			self.fp.seek(index[0])
 			return self.fp.read(index[1])
 		else:
@@ -183,19 +224,64 @@ class BukaFile:
 	def keys(self):
 		return self.files.keys()
 
-	def getfile(self, key, offset=0):
-		'''offset is for bup files.'''
+	def getfile(self, key, offset=0, size=None):
+		'''
+		offset is for bup files.
+		If size is specified, only reads the first size bytes.
+		'''
 		if key == 'chaporder.dat' and self._chaporderdat:
 			return self._chaporderdat
 		index = self.files[key]
-		self.fp.seek(index[0] + offset)
-		return self.fp.read(index[1] - offset)
+		if size is None or size > index[1] - offset:
+			size = index[1] - offset
+		return self._read(index[0] + offset, size)
+
+	def _read(self, pos, size):
+		if self._view is not None:
+			return self._view[pos:pos + size]
+		elif not self.chunksize:
+			self.fp.seek(pos)
+			return self.fp.read(size)
+		if not self._inchunk(pos, size):
+			start = pos - pos % 4096
+			self.fp.seek(start)
+			chunk = self.fp.read(max(self.chunksize, pos + size - start))
+			self._chunk = (start, memoryview(chunk))
+			if hasattr(os, 'posix_fadvise'):
+				# let the kernel prefetch the next chunk
+				os.posix_fadvise(self.fp.fileno(), start + len(chunk), self.chunksize, os.POSIX_FADV_WILLNEED)
+		start, chunk = self._chunk
+		return chunk[pos - start:pos - start + size]
+
+	def _inchunk(self, pos, size):
+		start, chunk = self._chunk
+		return start <= pos and pos + size <= start + len(chunk)
+
+	def sequential(self, chunksize=1048576):
+		'''
+		Prepares for reading all entries in offset order.
 
-	def extract(self, key, path):
+		Later reads are served from aligned chunks of chunksize bytes, and
+		the kernel is told to read ahead.
+		Returns [(key, offset, size)] sorted by offset.
+		'''
+		self.chunksize = chunksize
+		if self._view is None and hasattr(os, 'posix_fadvise'):
+			os.posix_fadvise(self.fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		return self.files.entriesbyoffset()
+
+	def extract(self, key, path, offset=0):
+		'''
+		Extracts an entry without reading it into memory.
+		offset is for bup files.
+		'''
+		unlinkoutput(path)
 		with open(path, 'wb') as w:
 			index = self.files[key]
-			self.fp.seek(index[0])
-			w.write(self.fp.read(index[1]))
+			if self._view is not None or self._inchunk(index[0] + offset, index[1] - offset):
+				w.write(self.getfile(key, offset))
+			else:
+				copyrange(self.fp, w, index[0] + offset, index[1] - offset)
 
 	def extractall(self, path):
 		if not os.path.exists(path):
@@ -203,6 +289,11 @@ class BukaFile:
 		for key in self.files:
 			self.extract(key, os.path.join(path, key))
 
+	def items(self):
+		'''Yields (name, content) pairs in TOC order.'''
+		for key in self.files:
+			yield key, self[key]
+
 	def __repr__(self):
 		return "<BukaFile comicid=%r comicname=%r chapid=%r>" % \
 			(self.comicid, self.comicname, self.chapid)
@@ -211,11 +302,248 @@ class BukaFile:
 		return "漫画: %s, %s" % (self.comicname, self.chapid)
 
 	def close(self):
+		if self.mm is not None:
+			self._view.release()
+			try:
+				self.mm.close()
+			except BufferError:
+				# Pages are still queued for decoding.
+				# The map is freed when the last view is dropped.
+				pass
+			self.mm = self._view = None
+		self._chunk = (0, b'')
 		self.fp.close()
 
 	def __del__(self):
+		self.close()
+
+class BukaStream:
+	'''
+	Reads the buka file from a non-seekable stream, such as a pipe or stdin.
+
+	The header and TOC are parsed on construction. Entries are yielded by
+	items() in offset order as the bytes arrive; only the bytes of entries
+	that overlap the next one are kept in memory.
+	'''
+	def __init__(self, fp, filename='<stream>'):
+		self.filename = filename
+		self.fp = fp
+		self._buff = bytearray(self._read(128))
+		if self._buff[0:4] != b'buka':
+			raise BadBukaFile('not a buka file')
+		self.version, self.comicid, self.chapid, self.comicname, pos, endhead = parsehead(bytes(self._buff))
+		if endhead + 1 > len(self._buff):
+			self._buff += self._read(endhead + 1 - len(self._buff))
+		self.files = parsetoc(bytes(self._buff[pos:endhead+1]))
+		del self._buff[:endhead+1]
+		# the absolute offset of self._buff[0]
+		self._pos = endhead + 1
+		self._chaporderdat, self.chapinfo = None, None
+
+	def _read(self, size):
+		'''Reads exactly size bytes unless EOF is reached.'''
+		chunks = []
+		while size > 0:
+			chunk = self.fp.read(min(size, 1048576))
+			if not chunk:
+				raise BadBukaFile('unexpected end of stream')
+			chunks.append(chunk)
+			size -= len(chunk)
+		return b''.join(chunks)
+
+	def __len__(self):
+		return len(self.files)
+
+	def __iter__(self):
+		return iter(self.files)
+
+	def __contains__(self, item):
+		return item in self.files
+
+	def keys(self):
+		return self.files.keys()
+
+	def items(self):
+		'''
+		Yields (name, content) pairs in offset order.
+		It can only be iterated once.
+		'''
+		for key, index in sorted(self.files.items(), key=lambda x: x[1]):
+			pointer, size = index
+			if pointer < self._pos:
+				raise BadBukaFile('entry %s is out of order' % key)
+			if pointer > self._pos + len(self._buff):
+				skip = pointer - self._pos - len(self._buff)
+				self._buff = bytearray()
+				while skip > 0:
+					skip -= len(self._read(min(skip, 1048576)))
+			else:
+				del self._buff[:pointer - self._pos]
+			self._pos = pointer
+			if size > len(self._buff):
+				self._buff += self._read(size - len(self._buff))
+			data = bytes(self._buff[:size])
+			if key == 'chaporder.dat':
+				self._chaporderdat = data
+				self.chapinfo = cachedcomicinfo(self.comicid, self.chapid, size, None, lambda: data)
+			yield key, data
+
+	def __repr__(self):
+		return "<BukaStream comicid=%r comicname=%r chapid=%r>" % \
+			(self.comicid, self.comicname, self.chapid)
+
+	def __str__(self):
+		return "漫画: %s, %s" % (self.comicname, self.chapid)
+
+	def close(self):
 		self.fp.close()
 
+def cachedcomicinfo(comicid, chapid, size, mtime, readfn):
+	'''
+	Gets the ComicInfo of an embedded chaporder.dat.
+
+	Archives of the same comic usually carry the same chaporder.dat, so the
+	parsed content is cached by comicid. The cached one is used if the size
+	and the mtime of the archive match; if only the mtime differs, the
+	content is compared. It is parsed again if the chapter is not in the
+	cached one (a newer chaporder.dat).
+	readfn is called to get the content only when needed.
+	A new ComicInfo is returned each time, so the caller may modify it.
+	'''
+	with _comicinfolock:
+		cached = _comicinfocache.get(comicid)
+	data = None
+	if cached and not (cached[0] == size and chapid in cached[4]):
+		cached = None
+	elif cached and cached[1] != mtime:
+		data = bytes(readfn())
+		if data != cached[2]:
+			cached = None
+	if cached is None:
+		if data is None:
+			data = bytes(readfn())
+		chaporder = json.loads(data.decode('utf-8'))
+		chapids = frozenset(int(d['cid']) for d in chaporder['links'])
+		cached = (size, mtime, data, chaporder, chapids)
+	with _comicinfolock:
+		_comicinfocache[comicid] = cached
+		_comicinfocache.move_to_end(comicid)
+		while len(_comicinfocache) > COMICINFO_CACHE_SIZE:
+			_comicinfocache.popitem(False)
+	chaporder = cached[3]
+	return ComicInfo(dict(chaporder, links=list(chaporder['links'])), comicid)
+
+def parsehead(buff):
+	'''
+	Parses the fixed part of the buka header.
+	Returns (version, comicid, chapid, comicname, tocstart, tocend).
+	'''
+	# I guess it's the version number.
+	# [4:8] is more likely a (minor) version
+	# [9:12] may be a major version or "file type"
+	version = struct.unpack('<II', buff[4:12])
+	comicid = struct.unpack('<I', buff[12:16])[0]
+	chapid = struct.unpack('<I', buff[16:20])[0]
+	pos = buff.find(b'\x00', 20)
+	comicname = buff[20:pos].decode(encoding='utf-8', errors='ignore')
+	pos += 1
+	endhead = pos + struct.unpack('<I', buff[pos:pos + 4])[0] - 1
+	pos += 4
+	return version, comicid, chapid, comicname, pos, endhead
+
+def parsetoc(buff):
+	'''Parses the TOC of a buka file into a BukaTOC.'''
+	return BukaTOC(buff)
+
+class BukaTOC:
+	'''
+	A compact entry table of a buka file.
+
+	The offsets and sizes are kept in array('I') columns, and the names are
+	kept as (start, end) positions into the raw TOC bytes. It behaves like
+	a read-only OrderedDict of {name: (offset, size)}.
+
+	The name -> index dict is only built on the first lookup, as most
+	archives are read in offset order without looking up names.
+	'''
+	__slots__ = ('offsets', 'sizes', '_starts', '_ends', '_blob', '_index')
+
+	def __init__(self, buff):
+		buff = self._blob = bytes(buff)
+		self.offsets = offsets = array('I')
+		self.sizes = sizes = array('I')
+		self._starts = starts = array('I')
+		self._ends = ends = array('I')
+		self._index = None
+		unpack_from = struct.Struct('<II').unpack_from
+		find = buff.find
+		pos = 0
+		length = len(buff)
+		while pos + 8 < length:
+			pointer, size = unpack_from(buff, pos)
+			end = find(b'\x00', pos + 8)
+			if end == -1:
+				end = length
+			offsets.append(pointer)
+			sizes.append(size)
+			starts.append(pos + 8)
+			ends.append(end)
+			pos = end + 1
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def name(self, index):
+		return self._blob[self._starts[index]:self._ends[index]].decode(encoding='utf-8', errors='ignore')
+
+	def index(self, key):
+		'''Finds the index of an entry by name.'''
+		if self._index is None:
+			# the last entry wins, as in a dict
+			self._index = {self.name(i): i for i in range(len(self.offsets))}
+		try:
+			return self._index[key]
+		except TypeError:
+			raise KeyError(key)
+
+	def __getitem__(self, key):
+		i = self.index(key)
+		return (self.offsets[i], self.sizes[i])
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __contains__(self, key):
+		try:
+			self.index(key)
+			return True
+		except KeyError:
+			return False
+
+	def __iter__(self):
+		for i in range(len(self.offsets)):
+			yield self.name(i)
+
+	def keys(self):
+		return list(self)
+
+	def values(self):
+		return list(zip(self.offsets, self.sizes))
+
+	def items(self):
+		return [(self.name(i), (self.offsets[i], self.sizes[i])) for i in range(len(self.offsets))]
+
+	def entriesbyoffset(self):
+		'''Returns [(name, offset, size)] sorted by offset.'''
+		offsets, sizes = self.offsets, self.sizes
+		return [(self.name(i), offsets[i], sizes[i]) for i in sorted(range(len(offsets)), key=offsets.__getitem__)]
+
+	def __repr__(self):
+		return 'BukaTOC(%r)' % self.items()
+
 class ComicInfo:
 	'''
 	Get comic information from chaporder.dat.
@@ -271,6 +599,88 @@ class ComicInfo:
 	def __str__(self):
 		return "漫画: %s" % (self.comicname)
 
+def updatecomicdict(comicdict, comicinfo):
+	'''Merges comicinfo into the entry of the same comic in comicdict.'''
+	if comicinfo.comicid in comicdict:
+		known = comicdict[comicinfo.comicid]
+		known.chaporder.update(comicinfo.chaporder)
+		known.chap.update(comicinfo.chap)
+		comicinfo = known
+	# writes through if comicdict is a ComicCatalog
+	comicdict[comicinfo.comicid] = comicinfo
+
+class ComicCatalog(dict):
+	'''
+	A persistent dict of comicid -> ComicInfo, stored in SQLite.
+
+	Entries are loaded from the database on first access. Setting an entry
+	marks it dirty, and flush() writes the dirty ones that have changed,
+	with all the known chapters kept in chaporder['links'], so chapter names
+	learned in previous runs are known even if their chaporder.dat is not
+	read this time.
+	'''
+	def __init__(self, dbname):
+		dict.__init__(self)
+		self.dbname = dbname
+		self.db = sqlite3.connect(dbname, check_same_thread=False)
+		# comicid -> the stored JSON, or None if not in the database
+		self.saved = {}
+		# comicids set since the last flush()
+		self.dirty = set()
+		with self.db:
+			self.db.execute('''CREATE TABLE IF NOT EXISTS comics (
+				comicid INTEGER PRIMARY KEY, comicname TEXT, chaporder TEXT)''')
+
+	def __repr__(self):
+		return "<ComicCatalog dbname=%r>" % self.dbname
+
+	def __missing__(self, key):
+		comicinfo = self.load(key)
+		if comicinfo is None:
+			raise KeyError(key)
+		return comicinfo
+
+	def __contains__(self, key):
+		return dict.__contains__(self, key) or self.load(key) is not None
+
+	def get(self, key, default=None):
+		return self[key] if key in self else default
+
+	def load(self, key):
+		if not isinstance(key, int):
+			return None
+		if key not in self.saved:
+			row = self.db.execute('SELECT chaporder FROM comics WHERE comicid = ?', (key,)).fetchone()
+			self.saved[key] = row and row[0]
+		if self.saved[key] is None:
+			return None
+		comicinfo = ComicInfo(json.loads(self.saved[key]), key)
+		dict.__setitem__(self, key, comicinfo)
+		return comicinfo
+
+	def __setitem__(self, key, comicinfo):
+		dict.__setitem__(self, key, comicinfo)
+		if isinstance(key, int):
+			self.dirty.add(key)
+
+	def flush(self):
+		'''Writes the changed entries, in one transaction.'''
+		with self.db:
+			for key in sorted(self.dirty):
+				comicinfo = dict.__getitem__(self, key)
+				chaporder = dict(comicinfo.chaporder, links=list(comicinfo.chap.values()))
+				data = json.dumps(chaporder, ensure_ascii=False, sort_keys=True)
+				if self.saved.get(key) == data:
+					continue
+				self.db.execute('INSERT OR REPLACE INTO comics VALUES (?, ?, ?)',
+					(key, comicinfo.comicname, data))
+				self.saved[key] = data
+		self.dirty.clear()
+
+	def close(self):
+		self.flush()
+		self.db.close()
+
 
 class DirMan:
 	'''
@@ -280,14 +690,34 @@ class DirMan:
 	* self.nodes - represents the directory tree and what it contains.
 	* self.comicdict - maintains the dictionary of known comic entries.
 	* self.dwebpman - puts decode requests
+
+	If nocopy is True, the files are read from origpath in place instead
+	of a copy in dirpath, and only the outputs are written into dirpath.
+	Unchanged sources in manifest are skipped, the converted ones are
+	appended to self.converted.
 	'''
 
-	def __init__(self, dirpath, dwebpman=None, origpath=None, comicdict={}):
+	def __init__(self, dirpath, dwebpman=None, origpath=None, comicdict={}, usemmap=False, workers=1, chapters=1, nocopy=False, manifest=None):
 		self.dirpath = dirpath.rstrip('\\/')
 		self.origpath = (origpath or dirpath).rstrip('\\/')
+		self.nocopy = nocopy
+		self.walkroot = self.origpath if nocopy else self.dirpath
+		self.manifest = manifest
+		self.converted = []
+		# the copied sources to remove after decoding, see removesources()
+		self.removefiles = []
 		self.nodes = tTree()
 		self.dwebpman = dwebpman
 		self.comicdict = comicdict
+		self.usemmap = usemmap
+		self.classifier = _classifier
+		self.workers = workers
+		# number of chapters extracted concurrently, see submit()
+		self.chapters = chapters
+		self.extractpool = None
+		# filled by prefetch()
+		self._listings = {}
+		self._loaded = {}
 
 	def __repr__(self):
 		return "<DirMan dirpath=%r origpath=%r>" % (self.dirpath, self.origpath)
@@ -309,91 +739,153 @@ class DirMan:
 		else:
 			return os.path.basename(filename)
 
+	def outpath(self, path):
+		'''Maps a path of the walked tree to the output tree.'''
+		if not self.nocopy:
+			return path
+		return os.path.normpath(os.path.join(self.dirpath, os.path.relpath(path, self.origpath)))
+
+	def srcpath(self, path):
+		'''Maps a path of the copied tree to its source.'''
+		return os.path.normpath(os.path.join(self.origpath, os.path.relpath(path, self.dirpath)))
+
 	def updatecomicdict(self, comicinfo):
-		if comicinfo.comicid in self.comicdict:
-			self.comicdict[comicinfo.comicid].chaporder.update(comicinfo.chaporder)
-			self.comicdict[comicinfo.comicid].chap.update(comicinfo.chap)
+		updatecomicdict(self.comicdict, comicinfo)
+
+	def walk(self):
+		'''
+		Walks the directory tree once, top-down, using os.scandir.
+
+		Yields typed events, all files of a directory before its subdirectories:
+		  ('chaporder', root, 'chaporder.dat')
+		  ('buka', root, name, packed)   packed: the directory is the chapter
+		  ('bup', root, name)
+		  ('image', root, name, ftype)
+		  ('tmp', root, name)
+		  ('index2', root, name)
+		  ('sqlite3', root, 'buka_store.sql')
+		  ('dir', root, subdirs)         after the files of root
+		'''
+		stack = [self.walkroot]
+		while stack:
+			root = stack.pop()
+			if root in self._listings:
+				subdirs, files = self._listings.pop(root)
+			else:
+				subdirs, files = self.listdir(root)
+			if any(name == 'chaporder.dat' for name, ftype in files):
+				yield ('chaporder', root, 'chaporder.dat')
+			listing = None
+			for name, ftype in files:
+				if (self.manifest and self.nocopy and ftype in ('buka', 'bup')
+						and self.manifest.unchanged(os.path.join(root, name))):
+					continue
+				if ftype == 'buka':
+					if listing is None:
+						listing = self.srclisting(root, subdirs, files)
+					# only a buka (and a chaporder) (and an index2)
+					yield ('buka', root, name, not listing[0] and (name == 'pack.dat' or len(listing[1])<4))
+				elif ftype == 'bup':
+					yield ('bup', root, name)
+				elif ftype in _imgfiletype:
+					yield ('image', root, name, ftype)
+				elif ftype == 'tmp':
+					yield ('tmp', root, name)
+				elif ftype == 'index2':
+					yield ('index2', root, name)
+				elif name == 'buka_store.sql':
+					yield ('sqlite3', root, name)
+			yield ('dir', root, [entry.name for entry in subdirs])
+			stack.extend(entry.path for entry in reversed(subdirs) if not entry.is_symlink())
+
+	def listdir(self, root, copytype=None):
+		'''
+		Returns ([DirEntry of subdirectories], [(name, ftype)]) of root.
+		In nocopy mode, or if copytype is True, only lists the files
+		copytree would have copied.
+		'''
+		if copytype is None:
+			copytype = self.nocopy
+		subdirs, files = [], []
+		try:
+			entries = list(os.scandir(root))
+		except OSError:
+			return subdirs, files
+		for entry in entries:
+			ftype = self.classifier.detect(entry.path, entry)
+			if ftype == 'dir':
+				subdirs.append(entry)
+			elif not copytype or ftype in _copytype:
+				files.append((entry.name, ftype))
+		return subdirs, files
+
+	def srclisting(self, root, subdirs, files):
+		'''
+		Returns the listing of the source folder of root, which decides
+		whether a .buka file is the chapter itself.
+
+		In incremental runs the unchanged sources are not copied into
+		self.dirpath, so the source folder is listed again.
+		'''
+		if self.manifest and not self.nocopy:
+			return self.listdir(self.srcpath(root), True)
+		return subdirs, files
+
+	def prefetch(self):
+		'''
+		Lists the directories and reads chaporder.dat and buka headers
+		using a pool of self.workers threads.
+
+		Only the I/O is done in parallel. walk() and scan() then consume
+		the prefetched results in the same order as a serial walk, so
+		self.nodes and self.comicdict come out the same.
+		'''
+		pool = threadpool.ThreadPool(self.workers)
+		def listed(request, result):
+			root, subdirs, files, loaded = result
+			self._listings[root] = (subdirs, files)
+			self._loaded.update(loaded)
+			for entry in subdirs:
+				if not entry.is_symlink():
+					pool.putRequest(threadpool.WorkRequest(self._prefetchdir, (entry.path,), callback=listed))
+		pool.putRequest(threadpool.WorkRequest(self._prefetchdir, (self.walkroot,), callback=listed))
+		pool.wait()
+		pool.dismissWorkers(self.workers)
+
+	def _prefetchdir(self, root):
+		subdirs, files = self.listdir(root)
+		loaded = {}
+		for name, ftype in files:
+			filename = os.path.join(root, name)
+			try:
+				if name == 'chaporder.dat':
+					loaded[filename] = ComicInfo(json.load(open(filename, 'r', encoding='utf-8')))
+				elif ftype == 'buka':
+					buka = loaded[filename] = BukaFile(filename)
+					buka.chapinfo
+					buka.close()
+			except Exception:
+				# let scan() meet the error again
+				loaded.pop(filename, None)
+		return root, subdirs, files, loaded
+
+	def load(self, kind, filename):
+		'''Returns the prefetched ComicInfo/BukaFile, or reads it.'''
+		obj = self._loaded.pop(filename, None)
+		if obj is not None:
+			return obj
+		elif kind == 'chaporder':
+			return ComicInfo(json.load(open(filename, 'r', encoding='utf-8')))
 		else:
-			self.comicdict[comicinfo.comicid] = comicinfo
+			return BukaFile(filename, self.usemmap)
 
 	def detect(self):
 		'''
 		Only detects directory contents.
 		'''
-		for root, subFolders, files in os.walk(self.dirpath):
-			dtype = None
-			if 'chaporder.dat' in files:
-				filename = os.path.join(root, 'chaporder.dat')
-				chaporder = ComicInfo(json.load(open(filename, 'r', encoding='utf-8')))
-				tempid = self.basename(root)
-				if tempid.isdigit():
-					tempid = int(tempid)
-					if tempid == chaporder.comicid:
-						dtype = dtype or ('comic', chaporder.comicname)
-					elif tempid in chaporder.chap:
-						dtype = dtype or ('chap', chaporder.comicname, chaporder.renamef(tempid))
-					elif chaporder.comicid is None:
-						dtype = dtype or ('comic', chaporder.comicname)
-						chaporder.comicid = tempid
-				self.updatecomicdict(chaporder)
-			for name in files:
-				filename = os.path.join(root, name)
-				if detectfile(filename) == 'buka' and not subFolders and (name == 'pack.dat' or len(files)<4):
-					# only a buka (and a chaporder) (and an index2)
-					buka = BukaFile(filename)
-					if buka.chapinfo:
-						chaporder = buka.chapinfo
-						self.updatecomicdict(chaporder)
-						tempid = self.basename(root)
-						if tempid.isdigit():
-							tempid = int(tempid)
-							dtype = dtype or ('chap', buka.comicname, chaporder.renamef(tempid))
-					elif buka.comicid in self.comicdict:
-						dtype = dtype or ('chap', buka.comicname, self.comicdict[buka.comicid].renamef(buka.chapid))
-				elif detectfile(filename) == 'buka':
-					buka = BukaFile(filename)
-					sp = splitpath(self.cutname(os.path.join(root, os.path.splitext(name)[0])))
-					if buka.chapinfo:
-						chaporder = buka.chapinfo
-						self.updatecomicdict(chaporder)
-						self.nodes[sp] = ('chap', buka.comicname, chaporder.renamef(buka.chapid))
-					elif buka.comicid in self.comicdict:
-						self.nodes[sp] = ('chap', buka.comicname, self.comicdict[buka.comicid].renamef(buka.chapid))
-					tempid = self.basename(root)
-					if tempid.isdigit():
-						tempid = int(tempid)
-						if tempid == buka.comicid:
-							dtype = dtype or ('comic', buka.comicname)
-				elif detectfile(filename) == 'bup':
-					pass
-				elif detectfile(filename) == 'tmp':
-					pass
-				elif name == 'buka_store.sql':
-					try:
-						cdict = buildfromdb(filename)
-						for key in cdict:
-							self.updatecomicdict(cdict[key])
-					except Exception:
-						pass
-			if root == self.dirpath:
-				rootdir = self.origpath
-			else:
-				rootdir = root
-			sp = splitpath(self.cutname(root))
-			if not dtype:
-				tempid = self.basename(rootdir)
-				if tempid.isdigit():
-					tempid = int(tempid)
-					if tempid in self.comicdict:
-						dtype = ('comic', self.comicdict[tempid].comicname)
-					else:
-						tempid2 = self.basename(os.path.dirname(root))
-						if tempid2.isdigit():
-							tempid2 = int(tempid2)
-							if tempid2 in self.comicdict:
-								if tempid in self.comicdict[tempid2].chap:
-									dtype = ('chap', self.comicdict[tempid2].comicname, self.comicdict[tempid2].renamef(tempid))
-			self.nodes[sp] = dtype
+		if self.workers > 1:
+			self.prefetch()
+		self.scan(False)
 		return self.nodes
 
 	def detectndecode(self):
@@ -401,19 +893,96 @@ class DirMan:
 		Detects what the directory contains, attach it to its contents,
 		and decode bup/webp images.
 		'''
-		# ifndef = lambda x,y: x if x else y
-		#        ==> x or y
 		if self.dwebpman is None:
 			raise NotImplementedError('dwebpman must be specified first.')
-		removefiles = []
-		for root, subFolders, files in os.walk(self.dirpath):
-			dtype = None
-			#frombup = set()
-			if 'chaporder.dat' in files:
-				filename = os.path.join(root, 'chaporder.dat')
-				chaporder = ComicInfo(json.load(open(filename, 'r', encoding='utf-8')))
-				logging.info(str(chaporder))
-				tempid = self.basename(root)
+		if self.chapters > 1:
+			self.extractpool = threadpool.ThreadPool(self.chapters, q_size=self.chapters)
+		try:
+			self.scan(True)
+		finally:
+			if self.extractpool:
+				self.extractpool.dismissWorkers(self.chapters)
+				self.extractpool = None
+
+	def submit(self, fn, *args):
+		'''
+		Runs an extraction job, in the extraction pool if there is one.
+		The decode requests of all jobs go to the same dwebpman.
+		'''
+		if self.extractpool is None:
+			fn(*args)
+			return
+		self.extractpool.putRequest(threadpool.WorkRequest(fn, args,
+			exc_callback=self.handle_thread_exception))
+		try:
+			self.extractpool.poll()
+		except threadpool.NoResultsPending:
+			pass
+
+	def handle_thread_exception(self, request, exc_info):
+		self.dwebpman.fail = True
+		logging.error('提取失败: %r', request.args[0])
+		traceback.print_exception(*exc_info, file=logstr)
+
+	def extractbuka(self, buka, path):
+		try:
+			extractndecode(buka, path, self.dwebpman)
+		finally:
+			buka.close()
+
+	def decodebup(self, filename, outname):
+		basename = os.path.splitext(outname)[0]
+		with open(filename, 'rb') as f:
+			f.seek(64)
+			bupfile = f.read()
+		# Don't use JPG files to cheat me!!!!!
+		#trueformat = detectfile(basename + '.webp', True)
+		trueformat = detectfile(bupfile, True)
+		self.dwebpman.sink.makedirs(os.path.dirname(outname))
+		if trueformat == 'webp':
+			logging.info('加入队列 ' + self.cutname(outname))
+			self.dwebpman.add(basename, bupfile, self.cutname(outname))
+		else:
+			self.dwebpman.sink.write('%s.%s' % (basename, trueformat), bupfile)
+			logging.info('完成转换 ' + self.cutname(outname))
+
+	def passthrough(self, filename, outname):
+		'''Links a metadata file to the output tree in nocopy mode.'''
+		if not os.path.isdir(os.path.dirname(outname)):
+			os.makedirs(os.path.dirname(outname))
+		linkfile(filename, outname)
+
+	def scan(self, decode=False):
+		'''
+		Consumes the events of walk() to fill self.nodes and self.comicdict.
+		If decode is True, also extracts and decodes the files.
+		'''
+		# ifndef = lambda x,y: x if x else y
+		#        ==> x or y
+		removefiles = self.removefiles
+		dtype = None
+		for event in self.walk():
+			# root is read from, out is written to
+			kind, root = event[0], event[1]
+			out = self.outpath(root)
+			if kind == 'dir':
+				self.nodes[splitpath(self.cutname(out))] = dtype or self.guessdtype(out)
+				dtype = None
+				continue
+			name = event[2]
+			filename = os.path.join(root, name)
+			outname = os.path.join(out, name)
+			if os.path.splitext(outname)[1] == '.view':
+				outname = os.path.splitext(outname)[0]
+			if decode and self.nocopy and kind in ('buka', 'bup'):
+				self.converted.append(filename)
+			if kind == 'chaporder':
+				chaporder = self.load(kind, filename)
+				if decode:
+					logging.info(str(chaporder))
+					if self.nocopy:
+						self.passthrough(filename, outname)
+				tempid = self.basename(out)
 				if tempid.isdigit():
 					tempid = int(tempid)
 					if tempid == chaporder.comicid:
@@ -424,144 +993,206 @@ class DirMan:
 						dtype = dtype or ('comic', chaporder.comicname)
 						chaporder.comicid = tempid
 				self.updatecomicdict(chaporder)
-			for name in files:
-				filename = os.path.join(root, name)
-				if detectfile(filename) == 'buka' and not subFolders and (name == 'pack.dat' or len(files)<4):
-					# only a buka (and a chaporder) (and an index2)
-					logging.info('正在提取 ' + self.cutname(filename))
-					buka = BukaFile(filename)
-					logging.info(str(buka))
-					if buka.chapinfo:
-						chaporder = buka.chapinfo
-						self.updatecomicdict(chaporder)
-						tempid = self.basename(root)
-						if tempid.isdigit():
-							tempid = int(tempid)
-							dtype = dtype or ('chap', buka.comicname, chaporder.renamef(tempid))
-					elif buka.comicid in self.comicdict:
-						dtype = dtype or ('chap', buka.comicname, self.comicdict[buka.comicid].renamef(buka.chapid))
-					extractndecode(buka, root, self.dwebpman)
-					buka.close()
-					removefiles.append(filename)
-				elif detectfile(filename) == 'buka':
-					logging.info('正在提取 ' + self.cutname(filename))
-					buka = BukaFile(filename)
+			elif kind == 'buka' and event[3]:
+				if decode:
+					logging.info('正在提取 ' + self.cutname(outname))
+				buka = self.load(kind, filename)
+				if decode:
 					logging.info(str(buka))
-					sp = splitpath(self.cutname(os.path.join(root, os.path.splitext(name)[0])))
-					if buka.chapinfo:
-						chaporder = buka.chapinfo
-						self.updatecomicdict(chaporder)
-						self.nodes[sp] = ('chap', buka.comicname, chaporder.renamef(buka.chapid))
-					elif buka.comicid in self.comicdict:
-						self.nodes[sp] = ('chap', buka.comicname, self.comicdict[buka.comicid].renamef(buka.chapid))
-					extractndecode(buka, os.path.join(root, os.path.splitext(name)[0]), self.dwebpman)
-					tempid = self.basename(root)
+				if buka.chapinfo:
+					chaporder = buka.chapinfo
+					self.updatecomicdict(chaporder)
+					tempid = self.basename(out)
 					if tempid.isdigit():
 						tempid = int(tempid)
-						if tempid == buka.comicid:
-							dtype = dtype or ('comic', buka.comicname)
-					buka.close()
-					removefiles.append(filename)
-				elif detectfile(filename) == 'bup':
-					basename = os.path.splitext(filename)[0]
-					with open(filename, 'rb') as f:
-						f.seek(64)
-						bupfile = f.read()
-					# Don't use JPG files to cheat me!!!!!
-					#trueformat = detectfile(basename + '.webp', True)
-					trueformat = detectfile(bupfile, True)
-					if trueformat == 'webp':
-						logging.info('加入队列 ' + self.cutname(filename))
-						#frombup.add(basename + '.webp')
-						self.dwebpman.add(basename, bupfile, self.cutname(filename))
-						#decodewebp(basename)
-					else:
-						with open('%s.%s' % (basename, trueformat), 'wb') as w:
-							w.write(bupfile)
-						logging.info('完成转换 ' + self.cutname(filename))
-					removefiles.append(filename)
-				elif detectfile(filename) == 'tmp':
-					logging.info('已忽略 ' + self.cutname(filename))
+						dtype = dtype or ('chap', buka.comicname, chaporder.renamef(tempid))
+				elif buka.comicid in self.comicdict:
+					dtype = dtype or ('chap', buka.comicname, self.comicdict[buka.comicid].renamef(buka.chapid))
+				if decode:
+					self.submit(self.extractbuka, buka, out)
 					removefiles.append(filename)
-				# No way! don't let webp's confuse the program.
-				#elif detectfile(filename) == 'webp':
-					#if os.path.isfile(os.path.splitext(filename)[0]+'.bup') or filename in frombup:
-						#continue
-					#logging.info('加入队列 ' + self.cutname(filename))
-					#self.dwebpman.add(os.path.splitext(filename)[0], self.cutname(filename))
-					##decodewebp(os.path.splitext(filename)[0])
-				elif name == 'buka_store.sql':
-					try:
-						cdict = buildfromdb(filename)
-						for key in cdict:
-							self.updatecomicdict(cdict[key])
-					except Exception:
-						logging.error('不是有效的数据库: ' + self.cutname(filename))
-				#else:
-					#dtype = 'unk'
-			#for name in subFolders:
-				#pass
-			if root == self.dirpath:
-				rootdir = self.origpath
-			else:
-				rootdir = root
-			sp = splitpath(self.cutname(root))
-			if not dtype:
-				tempid = self.basename(rootdir)
+				else:
+					buka.close()
+			elif kind == 'buka':
+				if decode:
+					logging.info('正在提取 ' + self.cutname(outname))
+				buka = self.load(kind, filename)
+				if decode:
+					logging.info(str(buka))
+				sp = splitpath(self.cutname(os.path.splitext(outname)[0]))
+				if buka.chapinfo:
+					chaporder = buka.chapinfo
+					self.updatecomicdict(chaporder)
+					self.nodes[sp] = ('chap', buka.comicname, chaporder.renamef(buka.chapid))
+				elif buka.comicid in self.comicdict:
+					self.nodes[sp] = ('chap', buka.comicname, self.comicdict[buka.comicid].renamef(buka.chapid))
+				tempid = self.basename(out)
 				if tempid.isdigit():
 					tempid = int(tempid)
-					if tempid in self.comicdict:
-						dtype = ('comic', self.comicdict[tempid].comicname)
-					else:
-						tempid2 = self.basename(os.path.dirname(root))
-						if tempid2.isdigit():
-							tempid2 = int(tempid2)
-							if tempid2 in self.comicdict:
-								if tempid in self.comicdict[tempid2].chap:
-									dtype = ('chap', self.comicdict[tempid2].comicname, self.comicdict[tempid2].renamef(tempid))
-			self.nodes[sp] = dtype
+					if tempid == buka.comicid:
+						dtype = dtype or ('comic', buka.comicname)
+				if decode:
+					self.submit(self.extractbuka, buka, os.path.splitext(outname)[0])
+					removefiles.append(filename)
+				else:
+					buka.close()
+			elif kind == 'bup' and decode:
+				self.submit(self.decodebup, filename, outname)
+				removefiles.append(filename)
+			elif kind == 'image' and decode and self.nocopy:
+				self.dwebpman.sink.link(filename, outname)
+			elif kind == 'image' and decode and not self.dwebpman.sink.ondisk:
+				# move the copied images into the archive
+				with open(filename, 'rb') as f:
+					self.dwebpman.sink.write(filename, f.read())
+				removefiles.append(filename)
+			elif kind == 'tmp' and decode:
+				logging.info('已忽略 ' + self.cutname(outname))
+				removefiles.append(filename)
+			elif kind == 'index2' and decode and self.nocopy:
+				self.passthrough(filename, outname)
+			elif kind == 'sqlite3':
+				if decode and self.nocopy:
+					self.passthrough(filename, outname)
+				try:
+					cdict = buildfromdb(filename)
+					for key in cdict:
+						self.updatecomicdict(cdict[key])
+				except Exception:
+					if decode:
+						logging.error('不是有效的数据库: ' + self.cutname(filename))
+		if self.extractpool:
+			self.extractpool.wait()
+		if isinstance(self.comicdict, ComicCatalog):
+			self.comicdict.flush()
+
+	def removesources(self):
+		'''
+		Removes the copied sources extracted by scan().
+		Call it after dwebpman has finished: with mmap, the queued pages are
+		views of the archives, which cannot be removed on Windows while mapped.
+		'''
+		if self.nocopy:
+			# the sources are not ours
+			return
 		# just for the low speed of Windows
-		for filename in removefiles:
+		for filename in self.removefiles:
 			tryremove(filename)
+		self.removefiles = []
+
+	def guessdtype(self, root):
+		'''Guesses the directory type by its name and the known comics.'''
+		if root == self.dirpath:
+			rootdir = self.origpath
+		else:
+			rootdir = root
+		tempid = self.basename(rootdir)
+		if tempid.isdigit():
+			tempid = int(tempid)
+			if tempid in self.comicdict:
+				return ('comic', self.comicdict[tempid].comicname)
+			else:
+				tempid2 = self.basename(os.path.dirname(root))
+				if tempid2.isdigit():
+					tempid2 = int(tempid2)
+					if tempid2 in self.comicdict:
+						if tempid in self.comicdict[tempid2].chap:
+							return ('chap', self.comicdict[tempid2].comicname, self.comicdict[tempid2].renamef(tempid))
+		return None
+
+	def planrename(self):
+		'''
+		Plans the renaming of self.nodes without touching any file.
 
-	def renamedirs(self):
-		'''Does the renaming.'''
+		Returns (plan, newparentpath). plan is a list of (src, dst, merge),
+		deepest first, so the parent of src is not moved yet when src is.
+		merge is True if dst is an existing directory/archive or the dst of
+		an earlier entry, then the contents are merged instead of renamed.
+		'''
 		ls = sorted(self.nodes.keys(), key=len, reverse=True)
 		newparentpath = self.dirpath
+		plan = []
+		taken = set()
 		for i in ls:
 			this = self.nodes.get(i)
 			parent = self.nodes.get(i[:-1])
-			if this:
-				newpath = origpath = os.path.join(os.path.dirname(self.dirpath), *i)
-				basepath = os.path.join(os.path.dirname(self.dirpath), *i[:-1])
-				if this[0] == 'comic':
-					newpath = os.path.join(basepath, this[1])
-					movedir(origpath, newpath)
-				elif parent:
-					if this[1] == parent[1]:
-						newpath = os.path.join(basepath, this[2])
-						movedir(origpath, newpath)
-					else:
-						newpath = os.path.join(basepath, '%s-%s' % (this[1], this[2]))
-						movedir(origpath, newpath)
-				else:
-					newpath = os.path.join(basepath, '%s-%s' % (this[1], this[2]))
-					movedir(origpath, newpath)
-				if len(i) == 1:
-					newparentpath = newpath
+			if not this:
+				continue
+			origpath = os.path.join(os.path.dirname(self.dirpath), *i)
+			basepath = os.path.join(os.path.dirname(self.dirpath), *i[:-1])
+			if this[0] == 'comic':
+				newpath = os.path.join(basepath, this[1])
+			elif parent and this[1] == parent[1]:
+				newpath = os.path.join(basepath, this[2])
+			else:
+				newpath = os.path.join(basepath, '%s-%s' % (this[1], this[2]))
+			if len(i) == 1:
+				newparentpath = newpath
+			if newpath == origpath or not (os.path.isdir(origpath) or os.path.isfile(origpath + '.cbz')):
+				continue
+			merge = (newpath in taken or os.path.exists(newpath)
+					or os.path.exists(newpath + '.cbz'))
+			taken.add(newpath)
+			plan.append((origpath, newpath, merge))
+		return plan, newparentpath
+
+	def renamedirs(self, dryrun=False):
+		'''
+		Does the renaming. If dryrun is True, only prints the plan.
+		'''
+		plan, newparentpath = self.planrename()
+		for src, dst, merge in plan:
+			if dryrun:
+				print('%s -> %s%s' % (self.cutname(src), self.cutname(dst), ' (合并)' if merge else ''))
+			else:
+				moveoutput(src, dst, merge)
 		return newparentpath
 
 def movedir(src, dst):
-	'''Avoid conflicts when moving into an exist directory.'''
+	'''
+	Avoid conflicts when moving into an exist directory.
+	Only the items that exist in both are merged one level deeper,
+	others are moved with one rename each.
+	A file that is already dst (a hard link by linkfile()) is removed.
+	'''
 	if src == dst:
 		pass
 	elif os.path.isdir(src) and os.path.isdir(dst):
+		existing = set(os.listdir(dst))
 		for item in os.listdir(src):
-			movedir(os.path.join(src, item), os.path.join(dst, item))
+			if item in existing:
+				movedir(os.path.join(src, item), os.path.join(dst, item))
+			else:
+				delayedtry(os.rename, os.path.join(src, item), os.path.join(dst, item))
 		os.rmdir(src)
+	elif os.path.isfile(dst) and os.path.samefile(src, dst):
+		# rename() does nothing if both are links to the same file
+		delayedtry(os.remove, src)
 	else:
 		delayedtry(shutil.move, src, dst)
 
+def moveoutput(src, dst, merge=True):
+	'''
+	Moves a chapter directory and/or its CBZ archive.
+	If merge is False, dst is known to be free and src is simply renamed.
+	'''
+	if os.path.isdir(src):
+		if merge:
+			movedir(src, dst)
+		else:
+			delayedtry(os.rename, src, dst)
+	if os.path.isfile(src + '.cbz'):
+		if merge:
+			movedir(src + '.cbz', dst + '.cbz')
+		else:
+			delayedtry(os.rename, src + '.cbz', dst + '.cbz')
+
+def removeemptydirs(dirpath):
+	'''Removes empty directories left behind by CBZSink.'''
+	for root, subFolders, files in os.walk(dirpath, topdown=False):
+		if not os.listdir(root):
+			os.rmdir(root)
+
 def delayedtry(fn, *args, **kwargs):
 	for att in range(10):
 		try:
@@ -615,37 +1246,110 @@ def splitpath(path):
 
 def extractndecode(bukafile, path, dwebpman):
 	'''Extracts buka files and puts decode requests.'''
-	if not os.path.exists(path):
-		os.makedirs(path)
-	for key in bukafile.files:
+	sink = dwebpman.sink
+	sink.makedirs(path)
+	if isinstance(bukafile, BukaStream):
+		entries = bukafile.items()
+	else:
+		# random access: read in offset order,
+		# pass-through entries are copied by extract()
+		entries = ((key, None) for key, offset, size in bukafile.sequential())
+	for key, content in entries:
 		if os.path.splitext(key)[1] == '.bup':
-			imgfile = bukafile.getfile(key, 64)
-			trueformat = detectfile(imgfile, True)
+			if content is None:
+				trueformat = detectfile(bukafile.getfile(key, 64, 32), True)
+			else:
+				imgfile = memoryview(content)[64:]
+				trueformat = detectfile(imgfile, True)
 			basename = os.path.join(path, os.path.splitext(key)[0])
 			if trueformat == 'webp':
+				if content is None:
+					imgfile = bukafile.getfile(key, 64)
 				dwebpman.add(basename, imgfile, os.path.join(os.path.basename(path), key))
 			else:
-				with open('%s.%s' % (basename, trueformat), 'wb') as w:
-					w.write(imgfile)
+				if content is None:
+					sink.extract(bukafile, key, '%s.%s' % (basename, trueformat), 64)
+				else:
+					sink.write('%s.%s' % (basename, trueformat), imgfile)
 				logging.info('完成转换 ' + os.path.join(os.path.basename(path), key))
 		elif key == 'logo':
-			imgfile = bukafile[key]
-			trueformat = detectfile(imgfile, True)
-			with open('%s.%s' % (os.path.join(path, key), trueformat), 'wb') as f:
-				f.write(imgfile)
+			if content is None:
+				content = bukafile[key]
+			trueformat = detectfile(content, True)
+			sink.write('%s.%s' % (os.path.join(path, key), trueformat), content)
+		elif content is None:
+			sink.extract(bukafile, key, os.path.join(path, key))
 		else:
-			with open(os.path.join(path, key), 'wb') as f:
-				f.write(bukafile[key])
+			sink.write(os.path.join(path, key), content)
+
+def copyrange(fsrc, fdst, offset, size):
+	'''
+	Copies size bytes at offset of file object fsrc to file object fdst.
+
+	Uses os.copy_file_range or os.sendfile to copy in the kernel,
+	and falls back to chunked copying if they are not available.
+	'''
+	fdst.flush()
+	infd, outfd = fsrc.fileno(), fdst.fileno()
+	for kcopy in ('copy_file_range', 'sendfile'):
+		if not hasattr(os, kcopy):
+			continue
+		try:
+			while size > 0:
+				if kcopy == 'copy_file_range':
+					sent = os.copy_file_range(infd, outfd, size, offset)
+				else:
+					sent = os.sendfile(outfd, infd, offset, size)
+				if not sent:
+					break
+				offset += sent
+				size -= sent
+			if not size:
+				return
+		except OSError as ex:
+			logging.debug("%s failed: %r", kcopy, ex)
+	fsrc.seek(offset)
+	while size > 0:
+		buff = fsrc.read(min(size, 1048576))
+		if not buff:
+			break
+		fdst.write(buff)
+		size -= len(buff)
+
+def unlinkoutput(filename):
+	'''
+	Removes an output file before writing it again.
+	In nocopy mode it may be a hardlink to a source file (see linkfile),
+	which must not be overwritten in place.
+	'''
+	try:
+		os.remove(filename)
+	except FileNotFoundError:
+		pass
+
+def linkfile(src, dst):
+	'''
+	Hardlinks src to dst, replacing dst.
+	Copies the file if hardlinks are not supported, eg. across filesystems.
+	'''
+	if os.path.isfile(dst):
+		if os.path.samefile(src, dst):
+			return
+		os.remove(dst)
+	try:
+		os.link(src, dst)
+	except OSError as ex:
+		logging.debug("link failed: %r", ex)
+		shutil.copy2(src, dst)
 
 def cleandir(dirpath):
 	'''
 	Remove non-image files.
 	'''
-	_imgfiletype = frozenset(('jpg', 'png', 'webp', 'gif'))
 	for root, subFolders, files in os.walk(dirpath):
 		for name in files:
 			filename = os.path.join(root, name)
-			if detectfile(filename) not in _imgfiletype:
+			if _classifier.detect(filename) not in _imgfiletype and not name.endswith('.cbz'):
 				tryremove(filename)
 
 def buildfromdb(dbname):
@@ -733,7 +1437,7 @@ def detectfile(fp, force=False):
 	'''
 	Tests file format.
 	If fp is str, treat it as a path;
-	If fp is bytes, treat it as a file;
+	If fp is bytes or memoryview, treat it as a file;
 	Else, treat it as a file-like object;
 
 	Parts from standard library imghdr.
@@ -746,29 +1450,13 @@ def detectfile(fp, force=False):
 		if not os.path.isfile(fp):
 			return False
 		if not force:
-			if os.path.basename(fp) == 'index2.dat':
-				return 'index2'
-			elif os.path.basename(fp) == 'chaporder.dat':
-				return 'chaporder'
-			ext = os.path.splitext(fp)[1]
-			if ext == '.buka':
-				return 'buka'
-			elif ext == '.bup':
-				return 'bup'
-			elif ext == '.view':
-				ext2 = os.path.splitext(os.path.splitext(fp)[0])[1]
-				if ext2 == '.jpg':
-					return 'jpg'
-				elif ext2 == '.bup':
-					return 'bup'
-				elif ext2 == '.png':
-					return 'png'
-			elif ext == '.tmp':
-				return 'tmp'
+			ftype = detectname(fp)
+			if ftype:
+				return ftype
 		with open(fp, 'rb') as f:
 			h = f.read(32)
-	elif isinstance(fp, bytes):
-		h = fp[:32]
+	elif isinstance(fp, (bytes, bytearray, memoryview)):
+		h = bytes(fp[:32])
 	else:
 		h = fp.peek(32)
 	if h[6:10] in (b'JFIF', b'Exif'):
@@ -791,20 +1479,92 @@ def detectfile(fp, force=False):
 	else:
 		return False
 
-def fileinfo(path):
-	ftype = detectfile(path)
-	if ftype is None:
-		return path + ':\n Not exist'
-	elif ftype is False:
-		return path + ':\n Unknown'
-	elif ftype == 'index2':
-		return path + ':\n Buka index2.dat image index file'
-	elif ftype == 'chaporder':
-		rv = [path + ':\n Buka chaporder.dat comic description file']
-		ci = ComicInfo.fromfile(path)
-		rv.append('Comic ID: %s' % ci.comicid)
-		rv.append('Comic Name: %s' % ci.comicname)
-		rv.append('Author: %s' % ci.chaporder.get('author'))
+def detectname(filename):
+	'''Tests file format by the file name only. Returns None if unsure.'''
+	name = os.path.basename(filename)
+	if name == 'index2.dat':
+		return 'index2'
+	elif name == 'chaporder.dat':
+		return 'chaporder'
+	ext = os.path.splitext(name)[1]
+	if ext == '.buka':
+		return 'buka'
+	elif ext == '.bup':
+		return 'bup'
+	elif ext == '.view':
+		ext2 = os.path.splitext(os.path.splitext(name)[0])[1]
+		if ext2 == '.jpg':
+			return 'jpg'
+		elif ext2 == '.bup':
+			return 'bup'
+		elif ext2 == '.png':
+			return 'png'
+	elif ext == '.tmp':
+		return 'tmp'
+	return None
+
+class FileClassifier:
+	'''
+	Tests file format like detectfile(path), but remembers the results.
+
+	The results are keyed by (path, inode, size, mtime), so each file is
+	classified once per run. An os.DirEntry from os.scandir can be passed
+	to reuse its stat data. The magic bytes are read with a single pread.
+	'''
+	def __init__(self):
+		self.cache = {}
+
+	def __repr__(self):
+		return "<FileClassifier cached=%d>" % len(self.cache)
+
+	def detect(self, path, entry=None):
+		try:
+			st = entry.stat() if entry is not None else os.stat(path)
+		except OSError:
+			return None
+		if stat.S_ISDIR(st.st_mode):
+			return 'dir'
+		elif not stat.S_ISREG(st.st_mode):
+			return False
+		key = (path, st.st_ino, st.st_size, st.st_mtime)
+		if key in self.cache:
+			return self.cache[key]
+		ftype = detectname(path)
+		if ftype is None:
+			try:
+				ftype = detectfile(self.readmagic(path), True)
+			except OSError:
+				return None
+		self.cache[key] = ftype
+		return ftype
+
+	@staticmethod
+	def readmagic(path, size=32):
+		fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+		try:
+			if hasattr(os, 'pread'):
+				return os.pread(fd, size, 0)
+			return os.read(fd, size)
+		finally:
+			os.close(fd)
+
+# shared by DirMan, copytree and cleandir
+_classifier = FileClassifier()
+
+def fileinfo(path, workers=1, comicdict=None):
+	ftype = detectfile(path)
+	if ftype is None:
+		return path + ':\n Not exist'
+	elif ftype is False:
+		return path + ':\n Unknown'
+	elif ftype == 'index2':
+		return path + ':\n Buka index2.dat image index file'
+	elif ftype == 'chaporder':
+		rv = [path + ':\n Buka chaporder.dat comic description file']
+		ci = ComicInfo.fromfile(path)
+		rv.append('Comic ID: %s' % ci.comicid)
+		rv.append('Comic Name: %s' % ci.comicname)
+		rv.append('Author: %s' % ci.chaporder.get('author'))
 		rv.append('Introduction: %s' % ci.chaporder.get('intro'))
 		return '\n'.join(rv)
 	elif ftype == 'bup':
@@ -846,10 +1606,12 @@ def fileinfo(path):
 			rv.append('Chapter Name: %s' % bf.chapinfo.renamef(bf.chapid))
 			rv.append('Author: %s' % bf.chapinfo.chaporder.get('author'))
 			rv.append('Introduction: %s' % bf.chapinfo.chaporder.get('intro'))
+		elif comicdict and bf.comicid in comicdict:
+			rv.append('Chapter Name: %s' % comicdict[bf.comicid].renamef(bf.chapid))
 		return '\n'.join(rv)
 	elif ftype == 'dir':
 		rv = [path + ':\n Directory']
-		dm = DirMan(path).detect()
+		dm = DirMan(path, comicdict={} if comicdict is None else comicdict, workers=workers).detect()
 		dml = sorted(dm.items())
 		def describe(item):
 			if item is None:
@@ -878,32 +1640,660 @@ def folderinfo(path):
 		for f in files:
 			print('{}{} : {}'.format(subindent, f))
 
-def copytree(src, dst, symlinks=False, ignore=None):
+def copytree(src, dst, symlinks=False, ignore=None, manifest=None, copied=None, workers=1):
+	'''
+	Copies the known files in src to dst, stripping the .view suffixes.
+	A file is skipped if dst has it with the same size and is not older.
+	If manifest is given, skips .buka/.bup files it has already converted,
+	and appends the sources of the copied ones to copied.
+	The files are copied by clonefile(), in a pool of workers threads.
+	'''
+	errors = []
+	pool = None
+	if workers > 1:
+		pool = threadpool.ThreadPool(workers, q_size=workers * 4)
+	try:
+		_copytree(src, dst, manifest, copied, pool, errors)
+		if pool:
+			pool.wait()
+	finally:
+		if pool:
+			pool.dismissWorkers(workers)
+	if errors:
+		raise errors[0][1].with_traceback(errors[0][2])
+
+def _copytree(src, dst, manifest, copied, pool, errors):
+	'''Returns the number of files copied or kept in dst.'''
 	if not os.path.exists(dst):
 		os.makedirs(dst)
-	for item in os.listdir(src):
-		s = os.path.join(src, item)
-		d = os.path.join(dst, item)
-		if os.path.isdir(s):
-			copytree(s, d, symlinks, ignore)
-		elif detectfile(s) in ('index2','chaporder','buka','bup','jpg','png','sqlite3'): # whitelist ,'webp'
+	count = 0
+	for entry in os.scandir(src):
+		s = entry.path
+		d = os.path.join(dst, entry.name)
+		ftype = _classifier.detect(s, entry)
+		if ftype == 'dir':
+			count += _copytree(s, d, manifest, copied, pool, errors)
+		elif ftype in _copytype:
 			if os.path.splitext(s)[1] == '.view':
 				d = os.path.splitext(d)[0]
-			if not os.path.isfile(d) or os.stat(src).st_mtime - os.stat(dst).st_mtime > 1:
-				shutil.copy2(s, d)
-	if not os.listdir(dst):
+			st = entry.stat()
+			if manifest and ftype in ('buka', 'bup'):
+				if manifest.unchanged(s, st):
+					continue
+				copied.append(s)
+			count += 1
+			try:
+				dst_st = os.stat(d)
+				if dst_st.st_size == st.st_size and st.st_mtime - dst_st.st_mtime <= 1:
+					continue
+			except FileNotFoundError:
+				pass
+			if pool is None:
+				clonefile(s, d)
+				continue
+			pool.putRequest(threadpool.WorkRequest(clonefile, (s, d),
+				exc_callback=lambda request, exc_info: errors.append(exc_info)))
+			try:
+				pool.poll()
+			except threadpool.NoResultsPending:
+				pass
+	if not count and not os.listdir(dst):
 		os.rmdir(dst)
+	return count
+
+def clonefile(src, dst):
+	'''
+	Copies src to dst with its metadata, like shutil.copy2.
+	Tries a reflink (FICLONE) first, which shares the data blocks on
+	btrfs/XFS, then copies in the kernel by copyrange().
+	'''
+	with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+		try:
+			if fcntl is None:
+				raise OSError('no fcntl')
+			fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+		except OSError:
+			copyrange(fsrc, fdst, 0, os.fstat(fsrc.fileno()).st_size)
+	shutil.copystat(src, dst)
+
+class Manifest:
+	'''
+	Records which sources have been converted into an output folder.
+
+	It is kept as a JSON file beside the output folder, because the output
+	folder itself may be renamed after the conversion. For the output
+	/a/out the file is /a/.out.bukamanifest.json.
+	The records are keyed by the source path relative to srcroot.
+	A source is unchanged if its size and mtime match;
+	if only the mtime differs, the content hash is compared.
+	'''
+	FILENAME = 'bukamanifest.json'
+
+	def __init__(self, dirpath, srcroot):
+		dirpath = os.path.abspath(dirpath).rstrip('\\/')
+		self.filename = os.path.join(os.path.dirname(dirpath), '.%s.%s' % (os.path.basename(dirpath), self.FILENAME))
+		self.srcroot = srcroot
+		try:
+			with open(self.filename, 'r', encoding='utf-8') as f:
+				self.d = json.load(f)
+		except (OSError, ValueError):
+			self.d = {}
+		self.skipped = 0
+
+	def __repr__(self):
+		return "<Manifest filename=%r sources=%d>" % (self.filename, len(self.d))
+
+	def unchanged(self, filename, st=None):
+		rec = self.d.get(os.path.relpath(filename, self.srcroot))
+		if not rec:
+			return False
+		st = st or os.stat(filename)
+		if rec['size'] != st.st_size:
+			return False
+		elif rec['mtime'] != st.st_mtime:
+			if rec['hash'] != hashfile(filename):
+				return False
+			rec['mtime'] = st.st_mtime
+		self.skipped += 1
+		return True
+
+	def add(self, filename):
+		'''Records that filename has been converted.'''
+		st = os.stat(filename)
+		self.d[os.path.relpath(filename, self.srcroot)] = {
+			'size': st.st_size, 'mtime': st.st_mtime, 'hash': hashfile(filename)}
+
+	def save(self):
+		tmpname = self.filename + '.tmp'
+		with open(tmpname, 'w', encoding='utf-8') as f:
+			json.dump(self.d, f, ensure_ascii=False, indent=0, sort_keys=True)
+		os.replace(tmpname, self.filename)
+
+def hashfile(filename):
+	h = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for buff in iter(lambda: f.read(1048576), b''):
+			h.update(buff)
+	return h.hexdigest()
+
+class PageIndex:
+	'''
+	A persistent index of pages in .buka archives, stored in SQLite.
+
+	Maps (comicid, chapid, name) to (archive path, offset, size, format).
+	For .bup entries the offset and size point to the wrapped image.
+	update() only reads archives whose mtime or size has changed, or whose
+	chapter could not be named from a chaporder.dat.
+	'''
+	def __init__(self, dbname):
+		self.dbname = dbname
+		# {comicid: ComicInfo} of the chaporder.dat files read
+		self.comicinfos = {}
+		self.db = sqlite3.connect(dbname, check_same_thread=False)
+		with self.db:
+			self.db.executescript('''
+				CREATE TABLE IF NOT EXISTS archives (
+					path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+					comicid INTEGER, chapid INTEGER);
+				CREATE TABLE IF NOT EXISTS chapters (
+					comicid INTEGER, chapid INTEGER, comicname TEXT, chapname TEXT,
+					path TEXT, PRIMARY KEY (comicid, chapid));
+				CREATE TABLE IF NOT EXISTS pages (
+					comicid INTEGER, chapid INTEGER, name TEXT, path TEXT,
+					offset INTEGER, size INTEGER, format TEXT,
+					PRIMARY KEY (comicid, chapid, name));
+				CREATE INDEX IF NOT EXISTS pages_path ON pages (path);
+			''')
+
+	def __repr__(self):
+		return "<PageIndex dbname=%r>" % self.dbname
+
+	def update(self, dirpath):
+		'''
+		Indexes new or changed archives under dirpath,
+		and forgets the removed ones. Returns the number of archives read.
+		'''
+		dirpath = os.path.abspath(dirpath)
+		prefix = os.path.join(dirpath, '')
+		known = dict((row[0], row[1:]) for row in self.db.execute(
+			'SELECT path, mtime, size FROM archives WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)))
+		unnamed = set(row[0] for row in self.db.execute(
+			'SELECT path FROM chapters WHERE chapname = CAST(chapid AS TEXT) AND substr(path, 1, ?) = ?', (len(prefix), prefix)))
+		seen = set()
+		count = 0
+		for root, subFolders, files in os.walk(dirpath):
+			for name in files:
+				filename = os.path.join(root, name)
+				if _classifier.detect(filename) != 'buka':
+					continue
+				seen.add(filename)
+				st = os.stat(filename)
+				if known.get(filename) == (st.st_mtime, st.st_size) and filename not in unnamed:
+					continue
+				try:
+					self.add(filename, st)
+					count += 1
+				except Exception:
+					logging.error('无法索引: ' + filename)
+					logging.debug(traceback.format_exc())
+		with self.db:
+			for filename in set(known) - seen:
+				self.remove(filename)
+			# archives read before the chaporder.dat of their comic
+			for comicid, chapid in self.db.execute(
+				'SELECT comicid, chapid FROM chapters WHERE chapname = CAST(chapid AS TEXT)').fetchall():
+				comicinfo = self.comicinfos.get(comicid)
+				if comicinfo and chapid in comicinfo.chap:
+					self.db.execute('UPDATE chapters SET chapname = ? WHERE comicid = ? AND chapid = ?',
+						(comicinfo.renamef(chapid), comicid, chapid))
+		return count
+
+	def comicinfo(self, buka, filename):
+		'''
+		Loads the ComicInfo naming the chapter of an archive: from its own
+		chaporder.dat, or the chaporder.dat beside it, or one read before.
+		'''
+		comicinfo = buka.chapinfo
+		if not comicinfo:
+			try:
+				with open(os.path.join(os.path.dirname(filename), 'chaporder.dat'), 'r', encoding='utf-8') as f:
+					comicinfo = ComicInfo(json.load(f), buka.comicid)
+			except (OSError, ValueError, KeyError):
+				comicinfo = None
+		if comicinfo and buka.chapid in comicinfo.chap:
+			self.comicinfos[buka.comicid] = comicinfo
+			return comicinfo
+		return self.comicinfos.get(buka.comicid, comicinfo)
+
+	def add(self, filename, st=None):
+		'''(Re)indexes one archive.'''
+		st = st or os.stat(filename)
+		buka = BukaFile(filename)
+		try:
+			comicinfo = self.comicinfo(buka, filename)
+			if comicinfo:
+				chapname = comicinfo.renamef(buka.chapid)
+			else:
+				chapname = str(buka.chapid)
+			rows = []
+			for key, pointer, size in buka.sequential():
+				if os.path.splitext(key)[1] == '.bup':
+					pointer, size = pointer + 64, size - 64
+					fmt = detectfile(buka.getfile(key, 64, 32), True)
+				elif key in ('chaporder.dat', 'index2.dat'):
+					fmt = os.path.splitext(key)[0]
+				else:
+					fmt = detectfile(buka.getfile(key, 0, 32), True)
+				rows.append((buka.comicid, buka.chapid, key, filename, pointer, size, fmt or None))
+		finally:
+			buka.close()
+		with self.db:
+			self.remove(filename)
+			self.db.execute('INSERT OR REPLACE INTO archives VALUES (?,?,?,?,?)',
+				(filename, st.st_mtime, st.st_size, buka.comicid, buka.chapid))
+			self.db.execute('INSERT OR REPLACE INTO chapters VALUES (?,?,?,?,?)',
+				(buka.comicid, buka.chapid, buka.comicname, chapname, filename))
+			self.db.executemany('INSERT OR REPLACE INTO pages VALUES (?,?,?,?,?,?,?)', rows)
+
+	def remove(self, filename):
+		self.db.execute('DELETE FROM pages WHERE path = ?', (filename,))
+		self.db.execute('DELETE FROM chapters WHERE path = ?', (filename,))
+		self.db.execute('DELETE FROM archives WHERE path = ?', (filename,))
+
+	def lookup(self, comicid, chapid, name):
+		'''Returns (path, offset, size, format), or None if not found.'''
+		return self.db.execute('SELECT path, offset, size, format FROM pages '
+			'WHERE comicid = ? AND chapid = ? AND name = ?', (comicid, chapid, name)).fetchone()
+
+	def read(self, comicid, chapid, name):
+		'''Returns (content, format) of a page.'''
+		row = self.lookup(comicid, chapid, name)
+		if row is None:
+			raise KeyError((comicid, chapid, name))
+		with open(row[0], 'rb') as f:
+			f.seek(row[1])
+			return f.read(row[2]), row[3]
+
+	def comics(self):
+		'''Returns [(comicid, comicname)].'''
+		return self.db.execute('SELECT DISTINCT comicid, comicname FROM chapters ORDER BY comicid').fetchall()
+
+	def chapters(self, comicid):
+		'''Returns [(chapid, chapname)] of a comic.'''
+		return self.db.execute('SELECT chapid, chapname FROM chapters WHERE comicid = ? ORDER BY chapid', (comicid,)).fetchall()
+
+	def pages(self, comicid, chapid):
+		'''Returns [(name, format, size)] of a chapter.'''
+		return self.db.execute('SELECT name, format, size FROM pages WHERE comicid = ? AND chapid = ? ORDER BY name', (comicid, chapid)).fetchall()
+
+	def close(self):
+		self.db.close()
+
+class LRUCache:
+	'''A thread-safe LRU cache limited by the total size of the values.'''
+	def __init__(self, maxbytes):
+		self.maxbytes = maxbytes
+		self.size = 0
+		self.d = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key, default=None):
+		with self.lock:
+			if key in self.d:
+				self.d.move_to_end(key)
+				return self.d[key]
+			return default
+
+	def put(self, key, value, size):
+		if size > self.maxbytes:
+			return
+		with self.lock:
+			if key in self.d:
+				self.size -= self.d.pop(key)[1]
+			self.d[key] = (value, size)
+			self.size += size
+			while self.size > self.maxbytes:
+				self.size -= self.d.popitem(last=False)[1][1]
+
+class PageServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	'''
+	Serves pages straight out of .buka archives.
+
+	  /                       comics, as JSON
+	  /<comicid>/             chapters, as JSON
+	  /<comicid>/<chapid>/    pages, as JSON
+	  /<comicid>/<chapid>/<name>  the page
+
+	WebP pages are decoded on demand by dwebpman, whose sink must be a
+	MemorySink, and kept in an LRU cache of cachesize bytes.
+	Concurrent requests of a page being decoded wait for the same decode.
+	'''
+	daemon_threads = True
+
+	def __init__(self, address, index, dwebpman, cachesize=256*1048576):
+		http.server.HTTPServer.__init__(self, address, PageRequestHandler)
+		self.index = index
+		self.indexlock = threading.Lock()
+		self.dwebpman = dwebpman
+		self.cache = LRUCache(cachesize)
+		# {etag: [threading.Event, (content, format) or None]} being decoded
+		self.decoding = {}
+		self.decodinglock = threading.Lock()
+
+	def getpage(self, comicid, chapid, name):
+		'''
+		Returns (path, offset, size, format, etag) of a page,
+		or None if not found. path is None if the page is decoded.
+		'''
+		with self.indexlock:
+			row = self.index.lookup(comicid, chapid, name)
+		if row is None:
+			return None
+		path, offset, size, fmt = row
+		try:
+			st = os.stat(path)
+		except OSError:
+			# removed after indexing
+			return None
+		etag = '"%x-%x-%x-%x"' % (int(st.st_mtime), st.st_size, offset, size)
+		if fmt == 'webp' and self.dwebpman.supportwebp:
+			return None, offset, size, fmt, etag
+		return path, offset, size, fmt, etag
+
+	def decodepage(self, comicid, chapid, name, etag):
+		'''Returns (content, format) of a decoded WebP page.'''
+		rv = self.cache.get(etag)
+		if rv is not None:
+			return rv[0]
+		with self.decodinglock:
+			job = self.decoding.get(etag)
+			owner = job is None
+			if owner:
+				job = self.decoding[etag] = [threading.Event(), None]
+		if not owner:
+			job[0].wait()
+			if job[1] is not None:
+				return job[1]
+			# the other decode failed, try again
+			return self._decodepage(comicid, chapid, name, etag)
+		try:
+			job[1] = self._decodepage(comicid, chapid, name, etag)
+			return job[1]
+		finally:
+			with self.decodinglock:
+				del self.decoding[etag]
+			job[0].set()
+
+	def _decodepage(self, comicid, chapid, name, etag):
+		with self.indexlock:
+			webpfile = self.index.read(comicid, chapid, name)[0]
+		basepath = '%x-%s' % (threading.get_ident(), etag)
+		self.dwebpman.decodewebp(basepath, webpfile, name)
+		out = self.dwebpman.sink.pop(basepath)
+		if out is None:
+			raise BadBukaFile('failed to decode %s/%s/%s' % (comicid, chapid, name))
+		rv = (out[1], os.path.splitext(out[0])[1][1:])
+		self.cache.put(etag, rv, len(out[1]))
+		return rv
+
+class PageRequestHandler(http.server.BaseHTTPRequestHandler):
+	'''The request handler of PageServer.'''
+	_mimetypes = {'jpg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp', 'gif': 'image/gif'}
+
+	def log_message(self, format, *args):
+		logging.debug(format, *args)
+
+	def do_GET(self):
+		parts = [urllib.parse.unquote(p) for p in urllib.parse.urlsplit(self.path).path.split('/') if p]
+		index = self.server.index
+		try:
+			with self.server.indexlock:
+				if not parts:
+					return self.sendjson([{'comicid': c, 'name': n} for c, n in index.comics()])
+				elif len(parts) == 1:
+					return self.sendjson([{'chapid': c, 'name': n} for c, n in index.chapters(int(parts[0]))])
+				elif len(parts) == 2:
+					return self.sendjson([{'name': n, 'format': f, 'size': s} for n, f, s in index.pages(int(parts[0]), int(parts[1]))])
+			if len(parts) == 3:
+				return self.sendpage(int(parts[0]), int(parts[1]), parts[2])
+		except ValueError:
+			pass
+		self.send_error(404)
+
+	def sendjson(self, obj):
+		data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json; charset=utf-8')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def sendpage(self, comicid, chapid, name):
+		page = self.server.getpage(comicid, chapid, name)
+		if page is None:
+			return self.send_error(404)
+		path, offset, size, fmt, etag = page
+		if self.headers.get('If-None-Match') == etag:
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			return self.end_headers()
+		if path is None:
+			try:
+				content, fmt = self.server.decodepage(comicid, chapid, name, etag)
+			except OSError:
+				return self.send_error(404)
+			except Exception:
+				logging.error('解码错误: %s/%s/%s' % (comicid, chapid, name))
+				traceback.print_exc(file=logstr)
+				return self.send_error(500)
+			size = len(content)
+		else:
+			try:
+				with open(path, 'rb') as f:
+					f.seek(offset)
+					content = f.read(size)
+			except OSError:
+				return self.send_error(404)
+		start, end = 0, size - 1
+		rangeh = self.headers.get('Range')
+		if rangeh:
+			start, end = parserange(rangeh, size)
+			if start is None:
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */%d' % size)
+				return self.end_headers()
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+		else:
+			self.send_response(200)
+		self.send_header('Content-Type', self._mimetypes.get(fmt, 'application/octet-stream'))
+		self.send_header('Content-Length', str(end - start + 1))
+		self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('ETag', etag)
+		self.end_headers()
+		self.wfile.write(memoryview(content)[start:end + 1])
+
+def parserange(header, size):
+	'''
+	Parses a single "bytes=" Range header.
+	Returns (start, end), or (None, None) if not satisfiable.
+	'''
+	try:
+		unit, spec = header.split('=', 1)
+		if unit.strip() != 'bytes' or ',' in spec:
+			return None, None
+		first, last = spec.strip().split('-', 1)
+		if first:
+			start = int(first)
+			end = int(last) if last else size - 1
+		else:
+			start = size - int(last)
+			end = size - 1
+	except ValueError:
+		return None, None
+	start = max(start, 0)
+	end = min(end, size - 1)
+	if start > end:
+		return None, None
+	return start, end
+
+def serve(dirpath, dwebpman, port, indexdb=':memory:'):
+	'''Indexes dirpath and serves it over HTTP until interrupted.'''
+	index = PageIndex(indexdb)
+	logging.info('正在索引...')
+	index.update(dirpath)
+	server = PageServer(('127.0.0.1', port), index, dwebpman)
+	logging.info('服务地址 http://127.0.0.1:%d/' % port)
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		index.close()
+
+class DirSink:
+	'''
+	Writes the output images as loose files in directories.
+	'''
+	ondisk = True
+
+	def __repr__(self):
+		return "<DirSink>"
+
+	def makedirs(self, path):
+		if not os.path.exists(path):
+			os.makedirs(path)
+
+	def write(self, filename, data):
+		unlinkoutput(filename)
+		with open(filename, 'wb') as f:
+			f.write(data)
+
+	def extract(self, bukafile, key, filename, offset=0):
+		bukafile.extract(key, filename, offset)
+
+	def link(self, src, filename):
+		'''Puts the existing file src as filename.'''
+		self.makedirs(os.path.dirname(filename))
+		linkfile(src, filename)
+
+	def saveimage(self, im, basepath, quality):
+		'''Saves a PIL image as JPG, or PNG if quality is 'png'.'''
+		if self.ondisk:
+			if quality == 'png':
+				unlinkoutput(basepath + '.png')
+				im.save(basepath + '.png')
+			else:
+				unlinkoutput(basepath + '.jpg')
+				im.save(basepath + '.jpg', quality=quality)
+			return
+		buff = BytesIO()
+		if quality == 'png':
+			im.save(buff, 'PNG')
+			self.write(basepath + '.png', buff.getvalue())
+		else:
+			im.save(buff, 'JPEG', quality=quality)
+			self.write(basepath + '.jpg', buff.getvalue())
+
+	def close(self):
+		pass
+
+class CBZSink(DirSink):
+	'''
+	Writes the output images into one CBZ (ZIP_STORED) archive per chapter.
+
+	Files in the directory <chapter> are appended to <chapter>.cbz as they
+	finish, so the directories are never created. The archives are renamed
+	along with the directories by DirMan.renamedirs.
+	At most maxopen archives are kept open; others are reopened to append.
+	'''
+	ondisk = False
+
+	def __init__(self, imagesonly=False, maxopen=32):
+		self.imagesonly = imagesonly
+		self.maxopen = maxopen
+		self.archives = OrderedDict()
+		self.lock = threading.Lock()
+
+	def __repr__(self):
+		return "<CBZSink imagesonly=%r>" % self.imagesonly
+
+	def makedirs(self, path):
+		pass
+
+	def write(self, filename, data):
+		if self.imagesonly and detectfile(data, True) not in _imgfiletype:
+			return
+		dirname, name = os.path.split(filename)
+		with self.lock:
+			if dirname in self.archives:
+				zf = self.archives[dirname]
+				self.archives.move_to_end(dirname)
+			else:
+				if len(self.archives) >= self.maxopen:
+					self.archives.popitem(last=False)[1].close()
+				zf = zipfile.ZipFile(dirname + '.cbz',
+					'a' if os.path.isfile(dirname + '.cbz') else 'w', zipfile.ZIP_STORED)
+				self.archives[dirname] = zf
+			zf.writestr(name, bytes(data))
+
+	def extract(self, bukafile, key, filename, offset=0):
+		self.write(filename, bukafile.getfile(key, offset))
+
+	def link(self, src, filename):
+		with open(src, 'rb') as f:
+			self.write(filename, f.read())
+
+	def close(self):
+		with self.lock:
+			while self.archives:
+				self.archives.popitem()[1].close()
+
+class MemorySink(DirSink):
+	'''
+	Keeps the output images in memory, for serving them.
+	Use pop(basepath) to take the result of a decode request.
+	'''
+	ondisk = False
+
+	def __init__(self):
+		self.files = {}
+		self.lock = threading.Lock()
+
+	def __repr__(self):
+		return "<MemorySink>"
+
+	def makedirs(self, path):
+		pass
+
+	def write(self, filename, data):
+		with self.lock:
+			self.files[filename] = bytes(data)
+
+	def extract(self, bukafile, key, filename, offset=0):
+		self.write(filename, bukafile.getfile(key, offset))
+
+	def pop(self, basepath):
+		'''Returns (filename, data) written for basepath, or None.'''
+		with self.lock:
+			for ext in ('.jpg', '.png', '.webp'):
+				if basepath + ext in self.files:
+					return basepath + ext, self.files.pop(basepath + ext)
 
 class DwebpMan:
 	'''
 	Use a pool of dwebp's to decode webps.
 	'''
-	def __init__(self, dwebppath=None, process=1, pilconvert=False, quality=92):
+	def __init__(self, dwebppath=None, process=1, pilconvert=False, quality=92, sink=None, maxbytes=0):
 		'''
 		If dwebppath is False, don't convert.
+		sink is where the images go, DirSink() by default.
+		maxbytes limits the webp files waiting, see decodepool().
 		'''
 		self.pilconvert = pilconvert
 		self.quality = quality
+		self.sink = sink or DirSink()
+		# the pixel buffer of each thread, see readpam()
+		self.local = threading.local()
 		programdir = os.path.dirname(os.path.abspath(sys.argv[0]))
 		self.fail = False
 		if '64' in platform.machine():
@@ -947,7 +2337,7 @@ class DwebpMan:
 		DEVNUL.close()
 		logging.debug("dwebp = " + self.dwebp)
 		if self.supportwebp:
-			self.pool = threadpool.NoOrderedRequestManager(process, self.decodewebp, self.checklog, self.handle_thread_exception, q_size=10)
+			self.pool = decodepool(self, process, maxbytes)
 		else:
 			self.pool = None
 
@@ -955,12 +2345,14 @@ class DwebpMan:
 		return "<DwebpMan supportwebp=%r dwebp=%r>" % (self.supportwebp, self.dwebp)
 
 	def add(self, basepath, webpfile, displayname):
-		'''Ignores if not supported.'''
+		'''
+		Ignores if not supported.
+		webpfile can be bytes or a memoryview from a mmap-ed BukaFile.
+		'''
 		if self.pool:
 			self.pool.putRequest(basepath, webpfile, displayname)
 		else:
-			with open(basepath + '.webp', 'wb') as f:
-				f.write(webpfile)
+			self.sink.write(basepath + '.webp', webpfile)
 
 	def wait(self):
 		self.pool.wait()
@@ -982,39 +2374,127 @@ class DwebpMan:
 
 	def decodewebp(self, basepath, webpfile, displayname):
 		if self.pilconvert:
-			proc = Popen([self.dwebp, "-bmp", "-o", "-", "--", "-"], stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=os.getcwd())
-			stdout, stderr = proc.communicate(webpfile)
-			if stdout:
-				self.convertpng(basepath, stdout)
+			# raw RGBA pixels, no BMP to parse
+			proc = Popen([self.dwebp, "-pam", "-o", "-", "--", "-"], stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=os.getcwd())
+			# write while reading, a large page doesn't fit in the pipe
+			writer = threading.Thread(target=self.feed, args=(proc.stdin, webpfile))
+			writer.start()
+			im = None
+			try:
+				im = self.readpam(proc.stdout, self.quality == 'png')
+			finally:
+				if im is None:
+					# stdout is not read to the end, dwebp may be blocked on it
+					proc.kill()
+				writer.join()
+				stderr = proc.stderr.read()
+				proc.stdout.close()
+				proc.stderr.close()
+				proc.wait()
+			if im is not None:
+				self.convertpng(basepath, im)
 			else:
 				# This will handled using stderr info.
 				pass
-		else:
+		elif self.sink.ondisk:
+			unlinkoutput(basepath + ".png")
 			proc = Popen([self.dwebp, "-o", basepath + ".png", "--", "-"], stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=os.getcwd())
 			stdout, stderr = proc.communicate(webpfile)
+		else:
+			proc = Popen([self.dwebp, "-o", "-", "--", "-"], stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=os.getcwd())
+			stdout, stderr = proc.communicate(webpfile)
+			if stdout:
+				self.sink.write(basepath + ".png", stdout)
 		#tryremove(basepath + ".webp")
 		if stderr:
 			stderr = stderr.decode(errors='ignore')
 		return (proc.returncode, stderr)
 
-	def convertpng(self, basepath, imgdata):
-		im = Image.open(BytesIO(imgdata))
-		if self.quality == 'png':
-			im.save(basepath + '.png')
+	@staticmethod
+	def feed(fp, data):
+		try:
+			fp.write(data)
+		except (BrokenPipeError, OSError):
+			# dwebp has quit, the error is in its stderr
+			pass
+		finally:
+			try:
+				fp.close()
+			except OSError:
+				pass
+
+	def readpam(self, fp, alpha=False):
+		'''
+		Reads a PAM image of dwebp into the buffer of this thread.
+		Returns a PIL image using the buffer, or None if truncated.
+		The image is RGBA if alpha is True and the PAM has an alpha channel,
+		otherwise RGBX (or RGB).
+		'''
+		header = {}
+		while 1:
+			line = fp.readline()
+			if not line:
+				return None
+			line = line.strip()
+			if line == b'ENDHDR':
+				break
+			elif b' ' in line:
+				key, value = line.split(None, 1)
+				header[key] = value
+		width, height = int(header[b'WIDTH']), int(header[b'HEIGHT'])
+		depth = int(header.get(b'DEPTH', 4))
+		if depth == 3:
+			mode = 'RGB'
+		elif alpha and header.get(b'TUPLTYPE') == b'RGB_ALPHA':
+			mode = 'RGBA'
 		else:
-			im.save(basepath + '.jpg', quality=self.quality)
+			mode = 'RGBX'
+		size = width * height * depth
+		buff = getattr(self.local, 'buff', None)
+		if buff is None or len(buff) < size:
+			# a new one, the old one may still be used by an image
+			buff = self.local.buff = bytearray(size)
+		view = memoryview(buff)
+		pos = 0
+		while pos < size:
+			n = fp.readinto(view[pos:size])
+			if not n:
+				return None
+			pos += n
+		view.release()
+		return Image.frombuffer(mode, (width, height), buff, 'raw', mode, 0, 1)
+
+	def convertpng(self, basepath, im):
+		if self.quality == 'png' and im.mode != 'RGB':
+			# keep the alpha channel only if it is used
+			if im.mode != 'RGBA' or im.getextrema()[3] == (255, 255):
+				im = im.convert('RGB')
+		self.sink.saveimage(im, basepath, self.quality)
 		im.close()
 		del im
 
+def decodepool(manager, process, maxbytes=0):
+	'''
+	Makes the thread pool of a decode manager.
+	If maxbytes is given, add() blocks on the total size of the webp files
+	queued or being decoded, otherwise on the number of queued files.
+	'''
+	if maxbytes:
+		return threadpool.NoOrderedRequestManager(process, manager.decodewebp, manager.checklog,
+			manager.handle_thread_exception, max_bytes=maxbytes,
+			sizeof=lambda basepath, webpfile, displayname: len(webpfile))
+	return threadpool.NoOrderedRequestManager(process, manager.decodewebp, manager.checklog, manager.handle_thread_exception, q_size=10)
+
 class DwebpPILMan:
 	"""
 	Use threads of PIL.Image instead of dwebp to decode webps.
 	"""
-	def __init__(self, process=1, quality=92):
+	def __init__(self, process=1, quality=92, sink=None, maxbytes=0):
 		self.quality = quality
+		self.sink = sink or DirSink()
 		self.supportwebp = True
 		self.fail = False
-		self.pool = threadpool.NoOrderedRequestManager(process, self.decodewebp, self.checklog, self.handle_thread_exception, q_size=10)
+		self.pool = decodepool(self, process, maxbytes)
 
 	def add(self, basepath, webpfile, displayname):
 		self.pool.putRequest(basepath, webpfile, displayname)
@@ -1027,6 +2507,7 @@ class DwebpPILMan:
 			logging.info("完成转换 %s", request.args[2])
 		else:
 			logging.error("解码错误: %s", request.args[2])
+			self.fail = True
 
 	def handle_thread_exception(self, request, exc_info):
 		"""Logging exception handler callback function."""
@@ -1037,10 +2518,7 @@ class DwebpPILMan:
 	def decodewebp(self, basepath, webpfile, displayname):
 		try:
 			im = Image.open(BytesIO(webpfile))
-			if self.quality == 'png':
-				im.save(basepath + '.png')
-			else:
-				im.save(basepath + '.jpg', quality=self.quality)
+			self.sink.saveimage(im, basepath, self.quality)
 			im.close()
 			del im
 			#tryremove(basepath + ".webp")
@@ -1057,8 +2535,9 @@ class DwebpSingleThreadPILMan:
 	"""
 	Use PIL.Image instead of dwebp to decode webps, using the main thread.
 	"""
-	def __init__(self, process=1, quality=92):
+	def __init__(self, process=1, quality=92, sink=None):
 		self.quality = quality
+		self.sink = sink or DirSink()
 		self.supportwebp = True
 		self.fail = False
 
@@ -1076,10 +2555,7 @@ class DwebpSingleThreadPILMan:
 	def decodewebp(self, basepath, webpfile, displayname):
 		try:
 			im = Image.open(BytesIO(webpfile))
-			if self.quality == 'png':
-				im.save(basepath + '.png')
-			else:
-				im.save(basepath + '.jpg', quality=self.quality)
+			self.sink.saveimage(im, basepath, self.quality)
 			im.close()
 			del im
 			#tryremove(basepath + ".webp")
@@ -1092,6 +2568,342 @@ class DwebpSingleThreadPILMan:
 			else:
 				raise ex
 
+class LibWebP:
+	'''
+	The WebP decoder of libwebp, loaded with ctypes.
+
+	Looks for libwebp_64.so/libwebp_64.dll/libwebp_mac.dylib beside the
+	program (like the dwebp binaries) first, then the system libwebp.
+	'''
+	class Features(ctypes.Structure):
+		'''WebPBitstreamFeatures'''
+		_fields_ = [('width', ctypes.c_int), ('height', ctypes.c_int),
+					('has_alpha', ctypes.c_int), ('has_animation', ctypes.c_int),
+					('format', ctypes.c_int), ('pad', ctypes.c_uint32 * 5)]
+
+	# only the major version is checked by libwebp
+	DECODER_ABI_VERSION = 0x0200
+
+	def __init__(self, libpath=None):
+		programdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+		bit = '64' if '64' in platform.machine() else '32'
+		if libpath:
+			candidates = [libpath]
+		elif os.name == 'nt' or sys.platform in ('win32', 'cygwin'):
+			candidates = [os.path.join(programdir, 'libwebp_%s.dll' % bit)]
+		elif sys.platform == 'darwin':
+			candidates = [os.path.join(programdir, 'libwebp_mac.dylib')]
+		else:
+			candidates = [os.path.join(programdir, 'libwebp_%s.so' % bit)]
+		if not libpath:
+			candidates.append(ctypes.util.find_library('webp'))
+		self.lib = None
+		for path in filter(None, candidates):
+			try:
+				self.lib = ctypes.CDLL(path)
+				self.libpath = path
+				break
+			except OSError as ex:
+				logging.debug("libwebp %s: %r", path, ex)
+		if self.lib is None:
+			raise OSError('libwebp not found')
+		self.lib.WebPGetFeaturesInternal.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.POINTER(self.Features), ctypes.c_int]
+		self.lib.WebPGetFeaturesInternal.restype = ctypes.c_int
+		self.lib.WebPDecodeRGBAInto.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+		self.lib.WebPDecodeRGBAInto.restype = ctypes.c_void_p
+		# the output buffer of each thread
+		self.local = threading.local()
+
+	def __repr__(self):
+		return "<LibWebP libpath=%r>" % self.libpath
+
+	def decode(self, webpfile):
+		'''
+		Decodes webpfile into a PIL image of mode RGBA or RGBX.
+		The image uses a buffer of this thread without copying, so it is
+		only valid until the next decode() in the same thread.
+		'''
+		if not isinstance(webpfile, bytes):
+			webpfile = bytes(webpfile)
+		features = self.Features()
+		if self.lib.WebPGetFeaturesInternal(webpfile, len(webpfile), ctypes.byref(features), self.DECODER_ABI_VERSION):
+			raise ValueError('not a valid webp image')
+		width, height = features.width, features.height
+		size = width * height * 4
+		buff = getattr(self.local, 'buff', None)
+		if buff is None or len(buff) < size:
+			# a new one, the old one may still be used by an image
+			buff = self.local.buff = bytearray(size)
+		out = (ctypes.c_char * size).from_buffer(buff)
+		try:
+			ok = self.lib.WebPDecodeRGBAInto(webpfile, len(webpfile), out, size, width * 4)
+		finally:
+			del out
+		if not ok:
+			raise ValueError('failed to decode webp image')
+		mode = 'RGBA' if features.has_alpha else 'RGBX'
+		return Image.frombuffer(mode, (width, height), buff, 'raw', mode, 0, 1)
+
+class DwebpLibMan:
+	"""
+	Use threads of libwebp (with ctypes) to decode webps, and PIL.Image to
+	save them. No dwebp process is started.
+	"""
+	def __init__(self, process=1, quality=92, sink=None, maxbytes=0, libpath=None):
+		self.libwebp = LibWebP(libpath)
+		self.quality = quality
+		self.sink = sink or DirSink()
+		self.supportwebp = True
+		self.fail = False
+		self.pool = decodepool(self, process, maxbytes)
+
+	def __repr__(self):
+		return "<DwebpLibMan libwebp=%r>" % self.libwebp
+
+	def add(self, basepath, webpfile, displayname):
+		self.pool.putRequest(basepath, webpfile, displayname)
+
+	def wait(self):
+		self.pool.wait()
+
+	def checklog(self, request, result):
+		if result:
+			logging.info("完成转换 %s", request.args[2])
+		else:
+			logging.error("解码错误: %s", request.args[2])
+			self.fail = True
+
+	def handle_thread_exception(self, request, exc_info):
+		"""Logging exception handler callback function."""
+		self.fail = True
+		logging.getLogger().error("<WorkRequest id=%s args[0]=%r kwargs=%r exception=%s>" % (request.requestID, request.args[0], request.kwds, request.exception))
+		traceback.print_exception(*exc_info, file=logstr)
+
+	def decodewebp(self, basepath, webpfile, displayname):
+		try:
+			im = self.libwebp.decode(webpfile)
+		except ValueError as ex:
+			logging.getLogger().debug('%s %s' % (basepath, repr(ex)))
+			return False
+		if im.mode == 'RGBX' and self.quality == 'png':
+			im = im.convert('RGB')
+		elif im.mode == 'RGBA' and self.quality != 'png':
+			im = im.convert('RGB')
+		self.sink.saveimage(im, basepath, self.quality)
+		im.close()
+		del im
+		return True
+
+class DwebpProcessPILMan:
+	"""
+	Use processes of PIL.Image to decode webps, not limited by the GIL.
+	The webp files are passed to the workers in shared memory.
+	"""
+	def __init__(self, process=1, quality=92, sink=None, maxbytes=0):
+		self.quality = quality
+		self.sink = sink or DirSink()
+		self.supportwebp = True
+		self.fail = False
+		# Ctrl-C is handled by the main process
+		self.pool = ProcessPoolExecutor(process, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+		# limits the pages in memory, like decodepool()
+		self.budget = threadpool.ByteBudget(maxbytes) if maxbytes else None
+		self.slots = threading.Semaphore(process + 10)
+		self.pending = 0
+		self.done = threading.Condition()
+
+	def __repr__(self):
+		return "<DwebpProcessPILMan pending=%d>" % self.pending
+
+	def add(self, basepath, webpfile, displayname):
+		size = len(webpfile)
+		if self.budget:
+			self.budget.acquire(size)
+		else:
+			self.slots.acquire()
+		with self.done:
+			self.pending += 1
+		shm = None
+		try:
+			shm = self.share(webpfile)
+			future = self.pool.submit(_decodeshared, shm.name, size, basepath, self.quality, self.sink.ondisk)
+		except Exception:
+			self.finish(None, shm, size, basepath, displayname)
+			raise
+		future.add_done_callback(lambda f: self.finish(f, shm, size, basepath, displayname))
+
+	def decodewebp(self, basepath, webpfile, displayname):
+		'''Decodes one webp and waits for it.'''
+		shm = self.share(webpfile)
+		try:
+			result = self.pool.submit(_decodeshared, shm.name, len(webpfile), basepath, self.quality, self.sink.ondisk).result()
+		finally:
+			shm.close()
+			shm.unlink()
+		if result:
+			self.sink.write(*result)
+		return result is not False
+
+	@staticmethod
+	def share(webpfile):
+		'''Copies webpfile into a new shared memory block.'''
+		size = len(webpfile)
+		shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+		shm.buf[:size] = webpfile
+		return shm
+
+	def wait(self):
+		with self.done:
+			while self.pending:
+				self.done.wait()
+
+	def finish(self, future, shm, size, basepath, displayname):
+		'''Called in a thread of the pool when a page is done.'''
+		try:
+			if shm is not None:
+				shm.close()
+				shm.unlink()
+			if future is None:
+				return
+			ex = future.exception()
+			if ex is not None:
+				self.fail = True
+				logging.getLogger().error("<DecodeRequest args[0]=%r exception=%r>" % (basepath, ex))
+				traceback.print_exception(type(ex), ex, ex.__traceback__, file=logstr)
+				return
+			result = future.result()
+			if result is False:
+				logging.error("解码错误: %s", displayname)
+				self.fail = True
+				return
+			elif result:
+				self.sink.write(*result)
+			logging.info("完成转换 %s", displayname)
+		finally:
+			with self.done:
+				self.pending -= 1
+				self.done.notify_all()
+			if self.budget:
+				self.budget.release(size)
+			else:
+				self.slots.release()
+
+def _decodeshared(shmname, size, basepath, quality, ondisk):
+	'''
+	Decodes the webp in shared memory in a worker process of DwebpProcessPILMan.
+	Saves the image if ondisk, otherwise returns (filename, data).
+	Returns False if the image is broken.
+	'''
+	shm = shared_memory.SharedMemory(shmname)
+	try:
+		with shm.buf[:size] as view:
+			fp = BytesIO(view)
+	finally:
+		shm.close()
+	try:
+		im = Image.open(fp)
+		if ondisk:
+			DirSink().saveimage(im, basepath, quality)
+			rv = None
+		else:
+			sink = MemorySink()
+			sink.saveimage(im, basepath, quality)
+			rv = sink.pop(basepath)
+		im.close()
+		return rv
+	except Exception as ex:
+		if 'image' in repr(ex):
+			return False
+		else:
+			raise ex
+
+class ConcurrencyTuner:
+	'''
+	Adjusts the number of decoding threads of a decode manager at run time.
+
+	Every interval seconds, the pages/s is compared with the last period:
+	the worker count keeps moving the same way while it gets faster, and
+	turns back when it gets slower. If the queue is nearly empty, the
+	workers are waiting for input (disk, extraction), so one is removed.
+	The count stays within [minworkers, maxworkers].
+	'''
+	def __init__(self, manager, workers, minworkers=1, maxworkers=None, interval=2):
+		self.pool = manager.pool.pool
+		self.workers = workers
+		self.minworkers = max(minworkers, 1)
+		self.maxworkers = max(maxworkers or workers, self.minworkers)
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.step = 1
+		self.lastrate = None
+		self.reset()
+		self.resize(min(max(workers, self.minworkers), self.maxworkers))
+		manager.pool.callback = self.wrap(manager.pool.callback)
+		manager.pool.exc_callback = self.wrap(manager.pool.exc_callback)
+
+	def __repr__(self):
+		return "<ConcurrencyTuner workers=%d range=%d-%d>" % (self.workers, self.minworkers, self.maxworkers)
+
+	def wrap(self, fn):
+		def wrapped(request, result):
+			try:
+				if fn:
+					fn(request, result)
+			finally:
+				self.done()
+		return wrapped
+
+	def reset(self):
+		self.start = time.time()
+		self.count = 0
+		self.queued = 0
+
+	def done(self):
+		'''Called when a page is done.'''
+		with self.lock:
+			self.count += 1
+			self.queued += self.pool.queueSize()
+			elapsed = time.time() - self.start
+			if elapsed >= self.interval:
+				self.adjust(self.count / elapsed, self.queued / self.count)
+				self.reset()
+
+	def adjust(self, rate, queued):
+		workers = self.workers
+		if queued < 1:
+			self.step = -1
+		elif self.lastrate is None or rate > self.lastrate * 1.05:
+			pass
+		elif rate < self.lastrate * 0.95:
+			self.step = -self.step
+		else:
+			self.step = 0
+		target = min(max(workers + self.step, self.minworkers), self.maxworkers)
+		if target == workers and self.step:
+			# at a bound, try the other way next time
+			self.step = -self.step
+		self.step = self.step or 1
+		self.lastrate = rate
+		logging.debug("autotune: %.1f 页/秒, 队列等待 %.2f 秒, 线程 %d -> %d", rate, queued / rate, workers, target)
+		self.resize(target)
+
+	def resize(self, target):
+		if target > self.workers:
+			self.pool.createWorkers(target - self.workers)
+		elif target < self.workers:
+			self.pool.dismissWorkers(self.workers - target)
+		self.workers = target
+
+def workerrange(value):
+	'''Parses 'MIN-MAX' of --autotune.'''
+	try:
+		lo, hi = map(int, value.split('-'))
+		if 1 <= lo <= hi:
+			return lo, hi
+	except ValueError:
+		pass
+	raise argparse.ArgumentTypeError("invalid range: %r, use MIN-MAX" % value)
+
 def downloader(comicid, chapid, path='.'):
 	"""
 	Experimental Buka downloader.
@@ -1154,6 +2966,369 @@ def logexit(err=True, wait=True):
 		time.sleep(NT_SLEEP_SEC)
 	sys.exit(int(err))
 
+def convertdir(src, dst, dwebpman, comicdict, args, manifest=None):
+	'''
+	Converts the folder src into dst and renames the results.
+	Returns the new path of dst.
+	'''
+	dm = DirMan(dst, dwebpman, src, comicdict, args.mmap, chapters=args.chapters, nocopy=args.no_copy, manifest=manifest)
+	if not args.no_copy:
+		logging.info('正在复制...')
+		copytree(src, dst, manifest=manifest, copied=dm.converted, workers=args.process)
+	dm.detectndecode()
+	if manifest:
+		logging.info('%d 个文件未改变，已跳过' % manifest.skipped)
+		manifest.skipped = 0
+	if dwebpman.supportwebp:
+		logging.info("等待所有转换进程/线程...")
+		dwebpman.wait()
+	dwebpman.sink.close()
+	dm.removesources()
+	if manifest and not dwebpman.fail:
+		for filename in dm.converted:
+			manifest.add(filename)
+		manifest.save()
+	logging.info("完成转换。")
+	logging.info("正在重命名...")
+	if args.clean:
+		cleandir(dst)
+	newpath = dm.renamedirs()
+	if args.cbz:
+		removeemptydirs(newpath)
+	return newpath
+
+class PollWatcher:
+	'''
+	Finds finished .buka/.bup downloads by polling the directory tree.
+	A file is finished when its size and mtime stay the same for one poll.
+	'''
+	def __init__(self, dirpath):
+		self.dirpath = dirpath
+		self.last = self.snapshot()
+		self.reported = dict(self.last)
+
+	def __repr__(self):
+		return "<PollWatcher dirpath=%r>" % self.dirpath
+
+	def snapshot(self):
+		rv = {}
+		for root, subFolders, files in os.walk(self.dirpath):
+			for name in files:
+				if iswatched(name):
+					filename = os.path.join(root, name)
+					try:
+						st = os.stat(filename)
+					except OSError:
+						continue
+					rv[filename] = (st.st_size, st.st_mtime)
+		return rv
+
+	def changes(self, timeout):
+		'''Waits timeout seconds and returns the newly finished files.'''
+		time.sleep(timeout)
+		current = self.snapshot()
+		rv = []
+		for filename, key in current.items():
+			if self.last.get(filename) == key and self.reported.get(filename) != key:
+				self.reported[filename] = key
+				rv.append(filename)
+		self.last = current
+		return rv
+
+	def close(self):
+		pass
+
+class InotifyWatcher:
+	'''
+	Finds finished .buka/.bup downloads with Linux inotify, through ctypes.
+	A file is finished when it is closed after writing or moved in.
+	'''
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_ISDIR = 0x40000000
+	_event = struct.Struct('iIII')
+
+	def __init__(self, dirpath):
+		self.dirpath = dirpath
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init failed')
+		self.wds = {}
+		self.found = []
+		for root, subFolders, files in os.walk(dirpath):
+			self.addwatch(root)
+
+	def __repr__(self):
+		return "<InotifyWatcher dirpath=%r>" % self.dirpath
+
+	def addwatch(self, path):
+		mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			logging.debug('inotify_add_watch failed: %s', path)
+		else:
+			self.wds[wd] = path
+
+	def changes(self, timeout):
+		'''Waits up to timeout seconds and returns the newly finished files.'''
+		rv, self.found = self.found, []
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return rv
+		buff = os.read(self.fd, 65536)
+		pos = 0
+		while pos + self._event.size <= len(buff):
+			wd, mask, cookie, length = self._event.unpack_from(buff, pos)
+			pos += self._event.size
+			name = os.fsdecode(buff[pos:pos + length].rstrip(b'\x00'))
+			pos += length
+			if wd not in self.wds:
+				continue
+			filename = os.path.join(self.wds[wd], name)
+			if mask & self.IN_ISDIR:
+				if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+					# files may have landed before the watch was added
+					for root, subFolders, files in os.walk(filename):
+						self.addwatch(root)
+						rv.extend(os.path.join(root, f) for f in files if iswatched(f))
+			elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and iswatched(name):
+				rv.append(filename)
+		return rv
+
+	def close(self):
+		os.close(self.fd)
+
+def iswatched(name):
+	'''Tells whether a file is a finished download to convert.'''
+	return detectname(name) in ('buka', 'bup') or name == 'pack.dat'
+
+def watch(srcroot, target, dwebpman, comicdict, args, interval=5):
+	'''
+	Converts srcroot into target, then keeps converting new downloads.
+
+	The decoder pool, the known comics and the manifest are kept between
+	conversions. A finished file triggers the conversion of its comic
+	folder, after no other file has finished for interval seconds.
+	'''
+	manifest = Manifest(target, srcroot)
+	# watch before the first conversion, or the downloads finished
+	# during it would be taken as already converted
+	try:
+		watcher = InotifyWatcher(srcroot)
+	except Exception as ex:
+		logging.debug('inotify: %r', ex)
+		watcher = PollWatcher(srcroot)
+	logging.debug('watcher = %r', watcher)
+	pending = set()
+	try:
+		convertdir(srcroot, target, dwebpman, comicdict, args, manifest)
+		logging.info('正在监视 ' + srcroot)
+		found = watcher.changes(0)
+		while 1:
+			for filename in found:
+				logging.info('发现 ' + filename)
+				if detectname(filename) == 'buka' and os.path.basename(filename) != 'pack.dat':
+					comicdir = os.path.dirname(filename)
+				else:
+					comicdir = os.path.dirname(os.path.dirname(filename))
+				if os.path.relpath(comicdir, srcroot).startswith(os.pardir):
+					comicdir = srcroot
+				pending.add(comicdir)
+			if pending and not found:
+				for comicdir in sorted(pending):
+					dst = os.path.normpath(os.path.join(target, os.path.relpath(comicdir, srcroot)))
+					newpath = convertdir(comicdir, dst, dwebpman, comicdict, args, manifest)
+					logging.info("输出至 " + newpath)
+				pending.clear()
+			found = watcher.changes(interval)
+	finally:
+		watcher.close()
+
+BACKENDS = ('dwebp', 'pil', 'pil-process', 'libwebp')
+
+def queuebytes(args):
+	'''The byte budget of the decode queue, see decodepool().'''
+	if args.queue_mb is None:
+		return max(64, 4 * args.process) * 1048576
+	return args.queue_mb * 1048576
+
+def makebackend(name, args, sink):
+	'''
+	Makes the decoder of the backend name, or returns None if it is not
+	available here.
+	'''
+	maxbytes = queuebytes(args)
+	if name == 'dwebp':
+		dwebpman = DwebpMan(args.dwebp, args.process, SUPPORTPIL, args.quality, sink, maxbytes)
+		return dwebpman if dwebpman.supportwebp else None
+	elif not SUPPORTPIL:
+		return None
+	elif name == 'pil':
+		return DwebpPILMan(args.process, args.quality, sink, maxbytes)
+	elif name == 'pil-process':
+		return DwebpProcessPILMan(args.process, args.quality, sink, maxbytes) if shared_memory else None
+	elif name == 'libwebp':
+		try:
+			return DwebpLibMan(args.process, args.quality, sink, maxbytes)
+		except OSError as ex:
+			logging.debug("libwebp: " + repr(ex))
+			return None
+
+def closebackend(dwebpman):
+	'''Stops the workers of a decoder that is no longer used.'''
+	pool = getattr(dwebpman, 'pool', None)
+	if isinstance(pool, threadpool.NoOrderedRequestManager):
+		pool.pool.dismissWorkers(len(pool.pool.workers))
+	elif isinstance(pool, ProcessPoolExecutor):
+		pool.shutdown()
+
+def samplewebp(path, count=8):
+	'''Returns up to count WebP pages found in the .buka/.bup files in path.'''
+	pages = []
+	if os.path.isdir(path):
+		filenames = (os.path.join(root, name) for root, subFolders, files in os.walk(path) for name in sorted(files))
+	else:
+		filenames = iter((path,))
+	for filename in filenames:
+		if len(pages) >= count:
+			break
+		ftype = _classifier.detect(filename)
+		try:
+			if ftype == 'buka':
+				buka = BukaFile(filename)
+				for key in buka.keys():
+					if len(pages) >= count:
+						break
+					if os.path.splitext(key)[1] == '.bup':
+						data = buka.getfile(key, 64)
+						if detectfile(data, True) == 'webp':
+							pages.append(bytes(data))
+				buka.close()
+			elif ftype == 'bup':
+				with open(filename, 'rb') as f:
+					f.seek(64)
+					data = f.read()
+				if detectfile(data, True) == 'webp':
+					pages.append(data)
+		except Exception as ex:
+			logging.debug("samplewebp %s: %r", filename, ex)
+	return pages
+
+def benchmark(dwebpman, pages, process):
+	'''
+	Returns the pages/s of dwebpman decoding pages into memory,
+	or 0 if any page is not decoded into an image.
+	'''
+	# warm up, not timed
+	dwebpman.add('warmup', pages[0], 'warmup')
+	dwebpman.wait()
+	total = max(16, 4 * process, len(pages))
+	starttime = time.time()
+	for i in range(total):
+		dwebpman.add('bench%d' % i, pages[i % len(pages)], 'bench%d' % i)
+	dwebpman.wait()
+	elapsed = time.time() - starttime
+	if dwebpman.fail:
+		return 0
+	for i in range(total):
+		out = dwebpman.sink.pop('bench%d' % i)
+		if out is None or out[0].endswith('.webp') or not out[1]:
+			logging.debug("benchmark %r: bench%d not decoded", dwebpman, i)
+			return 0
+	return total / max(elapsed, 1e-6)
+
+def backendcache():
+	if os.name == 'nt':
+		cachedir = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+	else:
+		cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(cachedir, 'bukaex-backend.json')
+
+def choosebackend(args):
+	'''
+	Finds the fastest available backend by decoding a few pages of the input
+	with each one. The result is cached per host, program/Pillow version and
+	-p, so it is only measured once. Returns None if nothing can be measured.
+	'''
+	pilversion = getattr(Image, '__version__', getattr(Image, 'PILLOW_VERSION', '')) if SUPPORTPIL else ''
+	key = '%s|%s|%s|%s|%d' % (platform.node(), __version__, pilversion, args.dwebp or '', args.process)
+	cachename = backendcache()
+	try:
+		with open(cachename, 'r', encoding='utf-8') as f:
+			cache = json.load(f)
+	except (OSError, ValueError):
+		cache = {}
+	if key in cache:
+		logging.debug("backend cache: %r", cache[key])
+		return cache[key]['backend']
+	if args.input == '-':
+		return None
+	pages = samplewebp(args.input.rstrip('\\/'))
+	if not pages:
+		logging.debug("no webp pages to measure")
+		return None
+	logging.info("正在测试解码器...")
+	rates = {}
+	# the pages are logged as usual by the decoders
+	quiet = lambda record: record.levelno != logging.INFO
+	logging.getLogger().addFilter(quiet)
+	try:
+		for name in BACKENDS:
+			dwebpman = makebackend(name, args, MemorySink())
+			if dwebpman is None:
+				continue
+			try:
+				rates[name] = benchmark(dwebpman, pages, args.process)
+			except Exception as ex:
+				logging.debug("benchmark %s: %r", name, ex)
+			finally:
+				closebackend(dwebpman)
+	finally:
+		logging.getLogger().removeFilter(quiet)
+	rates = dict((name, rate) for name, rate in rates.items() if rate)
+	if not rates:
+		return None
+	backend = max(rates, key=rates.get)
+	logging.info("解码器: %s (%s)" % (backend, ', '.join('%s %.1f 页/秒' % item for item in sorted(rates.items()))))
+	cache[key] = {'backend': backend, 'rates': rates, 'time': time.time()}
+	try:
+		if not os.path.isdir(os.path.dirname(cachename)):
+			os.makedirs(os.path.dirname(cachename))
+		with open(cachename, 'w', encoding='utf-8') as f:
+			json.dump(cache, f, indent=0, sort_keys=True)
+	except OSError as ex:
+		logging.debug("backend cache: %r", ex)
+	return backend
+
+def makedwebpman(args, sink):
+	'''Chooses the decoder according to the command line arguments.'''
+	maxbytes = queuebytes(args)
+	if args.keepwebp:
+		return DwebpMan(False, args.process, SUPPORTPIL, args.quality, sink)
+	backend = args.backend
+	if backend == 'auto':
+		backend = choosebackend(args)
+	if backend:
+		dwebpman = makebackend(backend, args, sink)
+		if dwebpman is not None:
+			return dwebpman
+		logging.error("解码器 %s 不可用，改用其他解码器。" % backend)
+	if args.dwebp:
+		return DwebpMan(args.dwebp, args.process, SUPPORTPIL, args.quality, sink, maxbytes)
+	if SUPPORTPIL and args.libwebp:
+		try:
+			return DwebpLibMan(args.process, args.quality, sink, maxbytes)
+		except OSError as ex:
+			logging.error("libwebp 不可用，改用其他解码器。")
+			logging.debug("libwebp: " + repr(ex))
+	if SUPPORTPIL and args.pil_process and shared_memory:
+		return DwebpProcessPILMan(args.process, args.quality, sink, maxbytes)
+	elif SUPPORTPIL and (args.pil or args.pil_process or PILFIXED):
+		return DwebpPILMan(args.process, args.quality, sink, maxbytes)
+	else:
+		return DwebpMan(args.dwebp, args.process, SUPPORTPIL, args.quality, sink, maxbytes)
+
 def main():
 	LOG_CONFIG = {'version':1,
 			'formatters':{'strlog':{'format':'*** %(levelname)s	%(funcName)s\n%(message)s'},
@@ -1182,11 +3357,27 @@ def main():
 	parser.add_argument("-l", "--log", action='store_true', help="Force logging to file.")
 	parser.add_argument("-n", "--keepwebp", action='store_true', help="Keep WebP, don't convert them.")
 	parser.add_argument("--pil", action='store_true', help="Perfer PIL/Pillow for decoding, faster.")
+	parser.add_argument("--pil-process", action='store_true', help="Use processes of PIL/Pillow for decoding, faster with many CPUs.")
 	parser.add_argument("--dwebp", help="Locate your own dwebp WebP decoder.", default=None)
+	parser.add_argument("--backend", help="The WebP decoder to use, 'auto' measures them with a few pages of <input> and picks the fastest. (Default: by the other options)", default=None, choices=('auto',) + BACKENDS)
+	parser.add_argument("--libwebp", action='store_true', help="Decode with libwebp in this process instead of running dwebp's.")
+	parser.add_argument("--index", help="Build or update a page index of the .buka files in <input>, then exit.", default=None, metavar='INDEX.db')
+	parser.add_argument("--serve", help="Serve the comics in <input> over HTTP on PORT instead of converting.", default=None, type=int, metavar='PORT')
+	parser.add_argument("--queue-mb", help="The max size of WebP data waiting for decoding, in MB. 0 means 10 files. (Default = max(64, 4 * NUM of -p))", default=None, type=int, metavar='MB')
+	parser.add_argument("--autotune", help="Adjust the number of decoding threads between MIN and MAX while running, starting from -p.", default=None, type=workerrange, metavar='MIN-MAX')
+	parser.add_argument("--chapters", help="The number of chapters extracted at the same time. (Default = 1)", default=1, type=int, metavar='NUM')
+	parser.add_argument("--rename-only", action='store_true', help="Only rename the folders in <input> by the comic/chapter names, don't convert anything.")
+	parser.add_argument("--dry-run", action='store_true', help="Print what --rename-only would rename without doing it.")
+	parser.add_argument("--no-copy", action='store_true', help="Read the files in <input> in place instead of copying them to <output> first. Images are hardlinked if possible.")
+	parser.add_argument("--watch", action='store_true', help="Keep watching the <input> folder and convert new downloads. Implies --incremental.")
+	parser.add_argument("--incremental", action='store_true', help="Skip the files converted by previous runs into the same output folder.")
+	parser.add_argument("--cbz", action='store_true', help="Write one .cbz archive per chapter instead of image files.")
+	parser.add_argument("--mmap", action='store_true', help="Memory-map .buka files instead of reading them, uses less memory.")
 	parser.add_argument("-q", "--quality", help="JPG quality, or 'png' for PNG loseless output. (Default = 92)", default=92, metavar='NUM|png')
+	parser.add_argument("--catalog", help="Keep the comic/chapter names found in every run in this database, and use them for renaming.", default=None, metavar='CATALOG.db')
 	parser.add_argument("-d", "--db", help="Locate the 'buka_store.sql' file in iOS devices, which provides infomation for renaming.", default=None, metavar='buka_store.sql')
 	parser.add_argument("--debug", action='store_true', help=argparse.SUPPRESS)
-	parser.add_argument("input", help="The .buka file or the folder containing files downloaded by Buka, which is usually located in (Android) /sdcard/ibuka/down")
+	parser.add_argument("input", help="The .buka file or the folder containing files downloaded by Buka, which is usually located in (Android) /sdcard/ibuka/down. Use '-' to read a .buka file from stdin.")
 	parser.add_argument("output", nargs='?', help="The output folder. (Default = ./output)", default=None)
 	args = parser.parse_args()
 	if not args.info:
@@ -1198,95 +3389,128 @@ def main():
 
 	programdir = os.path.dirname(os.path.abspath(sys.argv[0]))
 	fn_buka = args.input.rstrip('\\/')
-	if args.info:
-		print(fileinfo(fn_buka))
-		return
-	if args.output:
-		target = args.output
-	elif args.current_dir:
-		target = 'output'
-	else:
-		target = os.path.join(os.path.dirname(fn_buka), 'output')
-	target = os.path.abspath(target)
-	logging.info('输出至 ' + target)
-	if not os.path.exists(target):
-		os.makedirs(target)
 	dbdict = {}
 	if args.db:
 		try:
 			dbdict = buildfromdb(args.db)
 		except Exception:
 			logging.error('指定的数据库文件不是有效的 iOS 设备中的 buka_store.sql 数据库文件。提取过程将继续。')
-
-	logging.info("检查环境...")
-	#logging.debug(repr(os.uname()))
-	logging.debug('SUPPORTPIL = %r' % SUPPORTPIL)
-	if args.keepwebp:
-		dwebpman = DwebpMan(False, args.process, SUPPORTPIL, args.quality)
-	elif args.dwebp:
-		dwebpman = DwebpMan(args.dwebp, args.process, SUPPORTPIL, args.quality)
-	elif SUPPORTPIL and (args.pil or PILFIXED):
-		dwebpman = DwebpPILMan(args.process, args.quality)
-	else:
-		dwebpman = DwebpMan(args.dwebp, args.process, SUPPORTPIL, args.quality)
-	logging.debug("dwebpman = %r" % dwebpman)
-
-	if os.path.isdir(target):
-		if detectfile(fn_buka) == "buka":
-			if not os.path.isfile(fn_buka):
-				logging.critical('没有此文件: ' + fn_buka)
+	catalog = None
+	if args.catalog:
+		catalog = ComicCatalog(args.catalog)
+		for comicinfo in dbdict.values():
+			updatecomicdict(catalog, comicinfo)
+		dbdict = catalog
+	try:
+		if args.info:
+			print(fileinfo(fn_buka, args.process, dbdict))
+			return
+		if args.serve:
+			dwebpman = makedwebpman(args, MemorySink())
+			logging.debug("dwebpman = %r" % dwebpman)
+			serve(fn_buka, dwebpman, args.serve, args.index or ':memory:')
+			return
+		if args.index:
+			index = PageIndex(args.index)
+			logging.info('已索引 %d 个文件' % index.update(fn_buka))
+			index.close()
+			return
+		if args.rename_only or args.dry_run:
+			if not os.path.isdir(fn_buka):
+				logging.critical("输入必须为一个文件夹。")
+				logexit()
+			dm = DirMan(fn_buka, comicdict=dbdict, workers=args.process)
+			dm.detect()
+			newpath = dm.renamedirs(args.dry_run)
+			if newpath != fn_buka and not args.dry_run:
+				logging.info("输出至 " + newpath)
+			return
+		if args.output:
+			target = args.output
+		elif args.current_dir:
+			target = 'output'
+		else:
+			target = os.path.join(os.path.dirname(fn_buka), 'output')
+		target = os.path.abspath(target)
+		logging.info('输出至 ' + target)
+		if not os.path.exists(target):
+			os.makedirs(target)
+
+		logging.info("检查环境...")
+		#logging.debug(repr(os.uname()))
+		logging.debug('SUPPORTPIL = %r' % SUPPORTPIL)
+		if args.cbz:
+			sink = CBZSink(args.clean)
+		else:
+			sink = DirSink()
+		dwebpman = makedwebpman(args, sink)
+		logging.debug("dwebpman = %r" % dwebpman)
+		if args.autotune:
+			if isinstance(getattr(dwebpman, 'pool', None), threadpool.NoOrderedRequestManager):
+				tuner = ConcurrencyTuner(dwebpman, args.process, *args.autotune)
+				logging.debug("tuner = %r" % tuner)
+			else:
+				logging.warning("当前解码器不支持 --autotune。")
+
+		if os.path.isdir(target):
+			if fn_buka == '-' or detectfile(fn_buka) == "buka":
+				if fn_buka != '-' and not os.path.isfile(fn_buka):
+					logging.critical('没有此文件: ' + fn_buka)
+					if not os.listdir(target):
+						os.rmdir(target)
+					logexit()
+				logging.info('正在提取 ' + fn_buka)
+				if fn_buka == '-':
+					buka = BukaStream(sys.stdin.buffer)
+				else:
+					buka = BukaFile(fn_buka, args.mmap)
+				logging.info(str(buka))
+				extractndecode(buka, target, dwebpman)
+				if dwebpman.supportwebp:
+					dwebpman.wait()
+				sink.close()
+				if args.clean:
+					cleandir(target)
+				newpath = target
+				if buka.chapinfo:
+					newpath = os.path.join(os.path.dirname(target), "%s-%s" % (buka.comicname, buka.chapinfo.renamef(buka.chapid)))
+				else:
+					# cannot get chapter name
+					newpath = os.path.join(os.path.dirname(target), "%s-%s" % (buka.comicname, buka.chapid))
+				buka.close()
+				if newpath != target:
+					moveoutput(target, newpath)
+					logging.info("输出至 " + newpath)
+				if args.cbz:
+					removeemptydirs(newpath)
+			elif os.path.isdir(fn_buka) and args.watch:
+				watch(fn_buka, target, dwebpman, dbdict, args)
+			elif os.path.isdir(fn_buka):
+				manifest = None
+				if args.incremental:
+					manifest = Manifest(target, fn_buka)
+				newpath = convertdir(fn_buka, target, dwebpman, dbdict, args, manifest)
+				if newpath != target:
+					logging.info("输出至 " + newpath)
+			else:
+				logging.critical("输入必须为 buka 文件或一个文件夹。")
 				if not os.listdir(target):
 					os.rmdir(target)
 				logexit()
-			logging.info('正在提取 ' + fn_buka)
-			buka = BukaFile(fn_buka)
-			logging.info(str(buka))
-			extractndecode(buka, target, dwebpman)
-			if dwebpman.supportwebp:
-				dwebpman.wait()
-			if args.clean:
-				cleandir(target)
-			newpath = target
-			if buka.chapinfo:
-				newpath = os.path.join(os.path.dirname(target), "%s-%s" % (buka.comicname, buka.chapinfo.renamef(buka.chapid)))
-			else:
-				# cannot get chapter name
-				newpath = os.path.join(os.path.dirname(target), "%s-%s" % (buka.comicname, buka.chapid))
-			buka.close()
-			if newpath != target:
-				movedir(target, newpath)
-				logging.info("输出至 " + newpath)
-		elif os.path.isdir(fn_buka):
-			logging.info('正在复制...')
-			copytree(fn_buka, target)
-			dm = DirMan(target, dwebpman, fn_buka, dbdict)
-			dm.detectndecode()
-			if dwebpman.supportwebp:
-				logging.info("等待所有转换进程/线程...")
-				dwebpman.wait()
-			logging.info("完成转换。")
-			logging.info("正在重命名...")
-			if args.clean:
-				cleandir(target)
-			newpath = dm.renamedirs()
-			if newpath != target:
-				logging.info("输出至 " + newpath)
+			if dwebpman.fail:
+				logexit()
+			logging.info('完成。')
+			if not args.keepwebp and not dwebpman.supportwebp:
+				logging.warning('警告: .bup 格式保留为 WebP 格式，没有转换为普通图片。')
+				logexit()
+			if args.log:
+				logexit(False, False)
 		else:
-			logging.critical("输入必须为 buka 文件或一个文件夹。")
-			if not os.listdir(target):
-				os.rmdir(target)
-			logexit()
-		if dwebpman.fail:
-			logexit()
-		logging.info('完成。')
-		if not args.keepwebp and not dwebpman.supportwebp:
-			logging.warning('警告: .bup 格式保留为 WebP 格式，没有转换为普通图片。')
+			logging.critical("错误: 输出文件夹路径为一个文件。")
 			logexit()
-		if args.log:
-			logexit(False, False)
-	else:
-		logging.critical("错误: 输出文件夹路径为一个文件。")
-		logexit()
+	finally:
+		if catalog is not None:
+			catalog.close()
 
 if __name__ == '__main__':
 	try:
@@ -0,0 +1,697 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Tests of buka.py and threadpool.py.
+
+Run with `python -m pytest tests` or `python -m unittest discover tests`.
+'''
+import io
+import os
+import sys
+import json
+import queue
+import struct
+import argparse
+import contextlib
+import tempfile
+import threading
+import unittest
+import zipfile
+import http.client
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import buka
+import threadpool
+
+# enough of a WebP for detectfile()
+WEBP = b'RIFF\x10\x00\x00\x00WEBPVP8 ' + b'\x00' * 16
+JPG = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + b'\x00' * 16
+
+def tocentry(pointer, size, name, end=b'\x00'):
+	return struct.pack('<II', pointer, size) + name + end
+
+def bup(data):
+	return b'bup\x00' + b'\x00' * 60 + data
+
+def makebuka(comicid, chapid, files, comicname='TestComic'):
+	'''Returns the content of a .buka archive of files [(name, data)].'''
+	head = b'buka' + struct.pack('<IIII', 1, 2, comicid, chapid) + comicname.encode('utf-8') + b'\x00'
+	tocsize = sum(9 + len(name.encode('utf-8')) for name, data in files)
+	offset = len(head) + 4 + tocsize
+	toc = b''
+	for name, data in files:
+		toc += tocentry(offset, len(data), name.encode('utf-8'))
+		offset += len(data)
+	return head + struct.pack('<I', tocsize + 4) + toc + b''.join(data for name, data in files)
+
+def chaporder(comicid, chapids, comicname='TestComic'):
+	return json.dumps({'name': comicname, 'logo': 'http://x/%d-a.jpg' % comicid, 'links': [
+		{'cid': str(chapid), 'idx': str(i), 'title': '', 'type': '0'}
+		for i, chapid in enumerate(chapids, 1)]}).encode('utf-8')
+
+class RecordingMan:
+	'''A decode manager that only records the pages until wait().'''
+	supportwebp = True
+
+	def __init__(self, onwait=None):
+		self.sink = buka.DirSink()
+		self.fail = False
+		self.pages = []
+		self.onwait = onwait
+
+	def add(self, basepath, webpfile, displayname):
+		self.pages.append((basepath, webpfile))
+
+	def wait(self):
+		if self.onwait:
+			self.onwait(self)
+		self.pages = []
+
+class TempDirTestCase(unittest.TestCase):
+	def setUp(self):
+		self._tmp = tempfile.TemporaryDirectory()
+		self.tmp = self._tmp.name
+
+	def tearDown(self):
+		self._tmp.cleanup()
+
+	def writefile(self, filename, data):
+		filename = os.path.join(self.tmp, filename)
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with open(filename, 'wb') as f:
+			f.write(data)
+		return filename
+
+class TestBukaTOC(unittest.TestCase):
+	def setUp(self):
+		self.toc = buka.BukaTOC(
+			tocentry(10, 1, b'chaporder.dat') +
+			tocentry(20, 2, '封面.jpg'.encode('utf-8')) +
+			tocentry(30, 3, b'bad\xffname') +
+			tocentry(40, 4, b'chaporder.dat') +
+			tocentry(50, 5, b'last', b''))
+
+	def test_hit(self):
+		self.assertEqual(self.toc['封面.jpg'], (20, 2))
+		self.assertIn('封面.jpg', self.toc)
+
+	def test_last_entry_wins(self):
+		self.assertEqual(self.toc['chaporder.dat'], (40, 4))
+
+	def test_undecodable_names(self):
+		self.assertEqual(self.toc['badname'], (30, 3))
+		self.assertEqual(self.toc['last'], (50, 5))
+
+	def test_miss(self):
+		self.assertNotIn('missing.jpg', self.toc)
+		self.assertNotIn('chaporder', self.toc)
+		self.assertIsNone(self.toc.get('missing.jpg'))
+		self.assertRaises(KeyError, self.toc.__getitem__, 'missing.jpg')
+		self.assertRaises(KeyError, self.toc.__getitem__, 1)
+
+	def test_keys(self):
+		self.assertEqual(self.toc.keys(), ['chaporder.dat', '封面.jpg', 'badname', 'chaporder.dat', 'last'])
+
+	def test_entries_by_offset(self):
+		toc = buka.BukaTOC(tocentry(30, 3, b'b') + tocentry(10, 1, b'a'))
+		self.assertEqual(toc.entriesbyoffset(), [('a', 10, 1), ('b', 30, 3)])
+
+class PipeReader:
+	'''A stream that can only be read, in small pieces.'''
+	def __init__(self, data):
+		self.data = data
+		self.pos = 0
+
+	def read(self, size):
+		size = min(size, 7)
+		chunk = self.data[self.pos:self.pos + size]
+		self.pos += len(chunk)
+		return chunk
+
+	def close(self):
+		pass
+
+class TestBukaStream(unittest.TestCase):
+	def setUp(self):
+		self.files = [('chaporder.dat', chaporder(100, [201])), ('0000.bup', bup(WEBP)), ('logo', JPG)]
+		self.data = makebuka(100, 201, self.files)
+
+	def test_items(self):
+		stream = buka.BukaStream(PipeReader(self.data))
+		self.assertEqual((stream.comicid, stream.chapid, stream.comicname), (100, 201, 'TestComic'))
+		self.assertEqual(sorted(stream.keys()), sorted(name for name, data in self.files))
+		self.assertEqual(list(stream.items()), self.files)
+		self.assertEqual(stream.chapinfo.comicname, 'TestComic')
+
+	def test_truncated(self):
+		stream = buka.BukaStream(PipeReader(self.data[:-1]))
+		self.assertRaises(buka.BadBukaFile, list, stream.items())
+
+	def test_not_buka(self):
+		self.assertRaises(buka.BadBukaFile, buka.BukaStream, PipeReader(b'\x00' * 200))
+
+class TestCachedComicInfo(unittest.TestCase):
+	def setUp(self):
+		buka._comicinfocache.clear()
+		self.reads = 0
+
+	def reader(self, data):
+		def readfn():
+			self.reads += 1
+			return data
+		return readfn
+
+	def test_cached(self):
+		data = chaporder(100, [201, 202])
+		first = buka.cachedcomicinfo(100, 201, len(data), 1.0, self.reader(data))
+		second = buka.cachedcomicinfo(100, 202, len(data), 1.0, self.reader(data))
+		self.assertEqual(self.reads, 1)
+		self.assertEqual(sorted(second.chap), [201, 202])
+		# copies, not the cached one
+		first.chaporder['links'].pop()
+		self.assertEqual(len(second.chaporder['links']), 2)
+
+	def test_mtime_changed(self):
+		data = chaporder(100, [201])
+		buka.cachedcomicinfo(100, 201, len(data), 1.0, self.reader(data))
+		comicinfo = buka.cachedcomicinfo(100, 201, len(data), 2.0, self.reader(data))
+		self.assertEqual(self.reads, 2)
+		self.assertEqual(comicinfo.comicname, 'TestComic')
+		newdata = chaporder(100, [201], 'Renamed')
+		comicinfo = buka.cachedcomicinfo(100, 201, len(newdata), 3.0, self.reader(newdata))
+		self.assertEqual(comicinfo.comicname, 'Renamed')
+
+	def test_new_chapter(self):
+		data = chaporder(100, [201])
+		buka.cachedcomicinfo(100, 201, len(data), 1.0, self.reader(data))
+		newdata = chaporder(100, [201, 202])
+		comicinfo = buka.cachedcomicinfo(100, 202, len(newdata), 1.0, self.reader(newdata))
+		self.assertEqual(self.reads, 2)
+		self.assertIn(202, comicinfo.chap)
+
+class TestManifest(TempDirTestCase):
+	def setUp(self):
+		TempDirTestCase.setUp(self)
+		self.src = os.path.join(self.tmp, 'src')
+		self.target = os.path.join(self.tmp, 'out')
+		self.filename = self.writefile('src/100/200.buka', b'buka' + b'\x00' * 100)
+
+	def test_skip_after_save(self):
+		manifest = buka.Manifest(self.target, self.src)
+		self.assertFalse(manifest.unchanged(self.filename))
+		manifest.add(self.filename)
+		manifest.save()
+		self.assertTrue(os.path.isfile(os.path.join(self.tmp, '.out.' + buka.Manifest.FILENAME)))
+		manifest = buka.Manifest(self.target, self.src)
+		self.assertTrue(manifest.unchanged(self.filename))
+		self.assertEqual(manifest.skipped, 1)
+
+	def test_kept_when_output_renamed(self):
+		manifest = buka.Manifest(self.target, self.src)
+		manifest.add(self.filename)
+		os.makedirs(self.target)
+		manifest.save()
+		os.rename(self.target, os.path.join(self.tmp, 'TestComic'))
+		self.assertTrue(buka.Manifest(self.target, self.src).unchanged(self.filename))
+
+	def test_rerun_after_change(self):
+		manifest = buka.Manifest(self.target, self.src)
+		manifest.add(self.filename)
+		manifest.save()
+		# touched, same content
+		st = os.stat(self.filename)
+		os.utime(self.filename, (st.st_atime, st.st_mtime + 10))
+		self.assertTrue(buka.Manifest(self.target, self.src).unchanged(self.filename))
+		# same size, new content
+		self.writefile('src/100/200.buka', b'buka' + b'\x01' * 100)
+		self.assertFalse(buka.Manifest(self.target, self.src).unchanged(self.filename))
+
+class TestComicCatalog(TempDirTestCase):
+	def setUp(self):
+		TempDirTestCase.setUp(self)
+		self.dbname = os.path.join(self.tmp, 'catalog.db')
+
+	def comicinfo(self, chapids, comicname='TestComic'):
+		return buka.ComicInfo(json.loads(chaporder(100, chapids, comicname).decode('utf-8')))
+
+	def test_persisted(self):
+		catalog = buka.ComicCatalog(self.dbname)
+		buka.updatecomicdict(catalog, self.comicinfo([201]))
+		catalog.close()
+		catalog = buka.ComicCatalog(self.dbname)
+		self.assertIn(100, catalog)
+		self.assertEqual(catalog[100].comicname, 'TestComic')
+		self.assertEqual(catalog[100].renamef(201), '第001话')
+		self.assertNotIn(101, catalog)
+		self.assertNotIn('100', catalog)
+		self.assertIsNone(catalog.get(101))
+		self.assertRaises(KeyError, catalog.__getitem__, 101)
+		catalog.close()
+
+	def test_chapters_kept(self):
+		catalog = buka.ComicCatalog(self.dbname)
+		buka.updatecomicdict(catalog, self.comicinfo([201]))
+		catalog.close()
+		catalog = buka.ComicCatalog(self.dbname)
+		# a newer chaporder.dat without the old chapter
+		comicinfo = self.comicinfo([202])
+		comicinfo.chap[202]['idx'] = '2'
+		buka.updatecomicdict(catalog, comicinfo)
+		catalog.close()
+		catalog = buka.ComicCatalog(self.dbname)
+		self.assertEqual(sorted(catalog[100].chap), [201, 202])
+		self.assertEqual(catalog[100].renamef(202), '第002话')
+		catalog.close()
+
+	def test_unchanged_not_written(self):
+		catalog = buka.ComicCatalog(self.dbname)
+		buka.updatecomicdict(catalog, self.comicinfo([201]))
+		catalog.flush()
+		changes = catalog.db.total_changes
+		buka.updatecomicdict(catalog, self.comicinfo([201]))
+		catalog.flush()
+		self.assertEqual(catalog.db.total_changes, changes)
+		catalog.close()
+
+	def test_names_chapters_without_chaporder(self):
+		catalog = buka.ComicCatalog(self.dbname)
+		buka.updatecomicdict(catalog, self.comicinfo([201, 202, 203, 204]))
+		catalog.close()
+		for chapid in (201, 202, 203, 204):
+			self.writefile('src/100/%d.buka' % chapid, makebuka(100, chapid, [('0000.bup', bup(JPG))]))
+		catalog = buka.ComicCatalog(self.dbname)
+		args = argparse.Namespace(mmap=False, chapters=1, no_copy=True, process=1, clean=False, cbz=False)
+		newpath = buka.convertdir(os.path.join(self.tmp, 'src'), os.path.join(self.tmp, 'out'), RecordingMan(), catalog, args)
+		catalog.close()
+		self.assertEqual(sorted(os.listdir(os.path.join(newpath, 'TestComic'))), ['第001话', '第002话', '第003话', '第004话'])
+
+class TestNoCopyRerun(TempDirTestCase):
+	def setUp(self):
+		TempDirTestCase.setUp(self)
+		self.src = os.path.join(self.tmp, 'src')
+		self.target = os.path.join(self.tmp, 'out')
+		chaporder = {'name': 'TestComic', 'logo': 'http://x/100-a.jpg', 'links': [
+			{'cid': '201', 'idx': '1', 'title': 'One', 'type': '0'}]}
+		self.writefile('src/100/chaporder.dat', json.dumps(chaporder).encode('utf-8'))
+		self.page = self.writefile('src/100/201/0000.jpg', b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + b'\x00' * 100)
+		self.args = argparse.Namespace(mmap=False, chapters=1, no_copy=True, process=1, clean=False, cbz=False)
+
+	def convert(self):
+		dwebpman = buka.DwebpMan(False)
+		return buka.convertdir(self.src, self.target, dwebpman, {}, self.args)
+
+	def test_rerun(self):
+		for i in range(2):
+			newpath = self.convert()
+			self.assertEqual(newpath, self.target)
+			output = os.path.join(self.target, 'TestComic', 'One', '0000.jpg')
+			self.assertTrue(os.path.isfile(output))
+			self.assertEqual(os.listdir(self.target), ['TestComic'])
+		self.assertTrue(os.path.isfile(self.page))
+
+	def test_sources_unchanged(self):
+		sources = {
+			'src/100/201/chaporder.dat': chaporder(100, [201]),
+			'src/100/201/index2.dat': b'index2 of the source',
+			'src/100/201/0000.jpg': JPG + b'source',
+		}
+		# pack.dat embeds its own copies of the linked files
+		sources['src/100/201/pack.dat'] = makebuka(100, 201, [
+			('chaporder.dat', chaporder(100, [201], 'Packed')),
+			('index2.dat', b'index2 of the archive'),
+			('0000.bup', bup(JPG + b'archive')),
+		])
+		for filename, data in sources.items():
+			self.writefile(filename, data)
+		self.src = os.path.join(self.tmp, 'src', '100')
+		for i in range(2):
+			self.convert()
+			for filename, data in sources.items():
+				with open(os.path.join(self.tmp, filename), 'rb') as f:
+					self.assertEqual(f.read(), data, filename)
+
+	def test_movedir_hardlinks(self):
+		src = self.writefile('a/0000.jpg', b'page')
+		dst = os.path.join(self.tmp, 'b', '0000.jpg')
+		os.makedirs(os.path.dirname(dst))
+		os.link(src, dst)
+		buka.movedir(os.path.dirname(src), os.path.dirname(dst))
+		self.assertFalse(os.path.exists(os.path.dirname(src)))
+		with open(dst, 'rb') as f:
+			self.assertEqual(f.read(), b'page')
+
+class TestByteBudget(unittest.TestCase):
+	def test_acquire_release(self):
+		budget = threadpool.ByteBudget(100)
+		budget.acquire(60)
+		budget.acquire(40)
+		self.assertEqual(budget.in_flight, 100)
+		budget.release(60)
+		budget.release(40)
+		self.assertEqual(budget.in_flight, 0)
+
+	def test_blocks_until_released(self):
+		budget = threadpool.ByteBudget(100)
+		budget.acquire(80)
+		acquired = threading.Event()
+		def acquire():
+			budget.acquire(50)
+			acquired.set()
+		t = threading.Thread(target=acquire)
+		t.start()
+		self.assertFalse(acquired.wait(0.2))
+		budget.release(80)
+		self.assertTrue(acquired.wait(5))
+		t.join()
+		self.assertEqual(budget.in_flight, 50)
+
+	def test_oversized_alone(self):
+		budget = threadpool.ByteBudget(100)
+		budget.acquire(500)
+		self.assertEqual(budget.in_flight, 500)
+
+	def test_no_wait(self):
+		budget = threadpool.ByteBudget(100)
+		budget.acquire(80)
+		self.assertRaises(queue.Full, budget.acquire, 50, False)
+		self.assertRaises(queue.Full, budget.acquire, 50, True, 0.05)
+		self.assertEqual(budget.in_flight, 80)
+
+	def test_budget_full(self):
+		finish = threading.Event()
+		def work(size, **kwds):
+			finish.wait(5)
+		manager = threadpool.NoOrderedRequestManager(1, work, max_bytes=100,
+			sizeof=lambda size: size)
+		try:
+			manager.putRequest(80)
+			self.assertRaises(queue.Full, manager.putRequest, 50, block_=False)
+			self.assertRaises(queue.Full, manager.putRequest, 50, timeout_=0.05)
+			self.assertEqual(manager.budget.in_flight, 80)
+		finally:
+			finish.set()
+			manager.wait()
+			manager.pool.dismissWorkers(1)
+		self.assertEqual(manager.budget.in_flight, 0)
+
+	def test_released_when_not_queued(self):
+		started = threading.Event()
+		finish = threading.Event()
+		def work(size, **kwds):
+			started.set()
+			finish.wait(5)
+		manager = threadpool.NoOrderedRequestManager(1, work, q_size=1,
+			max_bytes=1000, sizeof=lambda size, **kwds: size)
+		try:
+			manager.putRequest(10)
+			self.assertTrue(started.wait(5))
+			manager.putRequest(20)
+			# the worker is busy and the queue is full
+			self.assertRaises(queue.Full, manager.putRequest, 40, block_=False)
+			self.assertEqual(manager.budget.in_flight, 30)
+		finally:
+			finish.set()
+			manager.wait()
+			manager.pool.dismissWorkers(1)
+		self.assertEqual(manager.budget.in_flight, 0)
+
+class StopWatching(Exception):
+	pass
+
+class TestWatch(TempDirTestCase):
+	def setUp(self):
+		TempDirTestCase.setUp(self)
+		self.src = os.path.join(self.tmp, 'src')
+		self.writefile('src/100/chaporder.dat', chaporder(100, [201, 202]))
+		self.writefile('src/100/201.buka', makebuka(100, 201, [('0000.bup', bup(WEBP))]))
+		self.args = argparse.Namespace(mmap=False, chapters=1, no_copy=False, process=1, clean=False, cbz=False)
+		self.converted = []
+
+	def onwait(self, man):
+		self.converted.append(len(man.pages))
+		if len(self.converted) == 1:
+			# finished during the first conversion
+			self.writefile('src/100/202.buka', makebuka(100, 202, [('0000.bup', bup(WEBP))]))
+		else:
+			raise StopWatching
+
+	def watch(self, watcher):
+		class Watcher(watcher):
+			polls = 0
+			def changes(self, timeout):
+				# give up after about 5 seconds
+				self.polls += 1
+				if self.polls > 50:
+					raise StopWatching
+				return watcher.changes(self, timeout)
+		inotify, poll = buka.InotifyWatcher, buka.PollWatcher
+		if watcher is poll:
+			def unavailable(dirpath):
+				raise OSError('inotify_init failed')
+			buka.InotifyWatcher = unavailable
+		else:
+			buka.InotifyWatcher = Watcher
+		buka.PollWatcher = Watcher
+		try:
+			self.assertRaises(StopWatching, buka.watch, self.src, os.path.join(self.tmp, 'out'),
+				RecordingMan(self.onwait), {}, self.args, 0.1)
+		finally:
+			buka.InotifyWatcher, buka.PollWatcher = inotify, poll
+		self.assertEqual(self.converted, [1, 1])
+
+	def test_inotify(self):
+		try:
+			buka.InotifyWatcher(self.src).close()
+		except Exception:
+			self.skipTest('no inotify')
+		self.watch(buka.InotifyWatcher)
+
+	def test_poll(self):
+		self.watch(buka.PollWatcher)
+
+class TestCBZSink(TempDirTestCase):
+	def namelist(self, filename):
+		with zipfile.ZipFile(os.path.join(self.tmp, filename)) as zf:
+			return zf.namelist()
+
+	def test_reopen(self):
+		sink = buka.CBZSink(maxopen=1)
+		sink.write(os.path.join(self.tmp, 'a', '0000.jpg'), JPG)
+		sink.write(os.path.join(self.tmp, 'b', '0000.jpg'), JPG)
+		sink.write(os.path.join(self.tmp, 'a', '0001.jpg'), memoryview(JPG))
+		sink.close()
+		self.assertEqual(self.namelist('a.cbz'), ['0000.jpg', '0001.jpg'])
+		self.assertEqual(self.namelist('b.cbz'), ['0000.jpg'])
+		self.assertFalse(os.path.exists(os.path.join(self.tmp, 'a')))
+
+	def test_imagesonly(self):
+		sink = buka.CBZSink(imagesonly=True)
+		sink.write(os.path.join(self.tmp, 'a', '0000.jpg'), JPG)
+		sink.write(os.path.join(self.tmp, 'a', 'chaporder.dat'), chaporder(100, [201]))
+		sink.close()
+		self.assertEqual(self.namelist('a.cbz'), ['0000.jpg'])
+
+	def test_convertdir(self):
+		# with fewer files, the folder would be taken as one packed chapter
+		self.writefile('src/100/chaporder.dat', chaporder(100, [201, 202, 203]))
+		for chapid in (201, 202, 203):
+			self.writefile('src/100/%d.buka' % chapid, makebuka(100, chapid, [('0000.bup', bup(JPG)), ('0001.bup', bup(JPG))]))
+		man = RecordingMan()
+		man.sink = buka.CBZSink(True)
+		args = argparse.Namespace(mmap=False, chapters=1, no_copy=True, process=1, clean=True, cbz=True)
+		newpath = buka.convertdir(os.path.join(self.tmp, 'src'), os.path.join(self.tmp, 'out'), man, {}, args)
+		self.assertEqual(os.listdir(newpath), ['TestComic'])
+		self.assertEqual(sorted(os.listdir(os.path.join(newpath, 'TestComic'))), ['第001话.cbz', '第002话.cbz', '第003话.cbz'])
+		self.assertEqual(self.namelist(os.path.join(newpath, 'TestComic', '第001话.cbz')), ['0000.jpg', '0001.jpg'])
+
+class TestPageIndex(TempDirTestCase):
+	def setUp(self):
+		TempDirTestCase.setUp(self)
+		self.src = os.path.join(self.tmp, 'src')
+		self.writefile('src/100/chaporder.dat', chaporder(100, [201, 202]))
+		self.archive = self.writefile('src/100/201.buka', makebuka(100, 201, [('0000.bup', bup(WEBP)), ('0001.jpg', JPG)]))
+		self.index = buka.PageIndex(os.path.join(self.tmp, 'index.db'))
+
+	def tearDown(self):
+		self.index.close()
+		TempDirTestCase.tearDown(self)
+
+	def test_update(self):
+		self.assertEqual(self.index.update(self.src), 1)
+		self.assertEqual(self.index.comics(), [(100, 'TestComic')])
+		self.assertEqual(self.index.chapters(100), [(201, '第001话')])
+		self.assertEqual(self.index.pages(100, 201), [('0000.bup', 'webp', len(WEBP)), ('0001.jpg', 'jpg', len(JPG))])
+		self.assertEqual(self.index.read(100, 201, '0000.bup'), (WEBP, 'webp'))
+		self.assertRaises(KeyError, self.index.read, 100, 201, '0002.jpg')
+
+	def test_unchanged(self):
+		self.index.update(self.src)
+		self.assertEqual(self.index.update(self.src), 0)
+		self.writefile('src/100/202.buka', makebuka(100, 202, [('0000.bup', bup(JPG))]))
+		self.assertEqual(self.index.update(self.src), 1)
+		self.assertEqual(self.index.chapters(100), [(201, '第001话'), (202, '第002话')])
+
+	def test_removed(self):
+		self.index.update(self.src)
+		os.remove(self.archive)
+		self.assertEqual(self.index.update(self.src), 0)
+		self.assertEqual(self.index.comics(), [])
+		self.assertIsNone(self.index.lookup(100, 201, '0000.bup'))
+
+class TestParseRange(unittest.TestCase):
+	def test_ranges(self):
+		self.assertEqual(buka.parserange('bytes=0-9', 100), (0, 9))
+		self.assertEqual(buka.parserange('bytes=90-', 100), (90, 99))
+		self.assertEqual(buka.parserange('bytes=-10', 100), (90, 99))
+		self.assertEqual(buka.parserange('bytes=50-200', 100), (50, 99))
+		self.assertEqual(buka.parserange('bytes=-200', 100), (0, 99))
+
+	def test_unsatisfiable(self):
+		self.assertEqual(buka.parserange('bytes=100-', 100), (None, None))
+		self.assertEqual(buka.parserange('bytes=9-0', 100), (None, None))
+		self.assertEqual(buka.parserange('bytes=0-1,5-6', 100), (None, None))
+		self.assertEqual(buka.parserange('items=0-9', 100), (None, None))
+		self.assertEqual(buka.parserange('bytes=a-b', 100), (None, None))
+
+class MemoryMan:
+	'''A decode manager that "decodes" a page to PNG into a MemorySink.'''
+	supportwebp = True
+
+	def __init__(self):
+		self.sink = buka.MemorySink()
+		self.decoded = 0
+
+	def decodewebp(self, basepath, webpfile, displayname):
+		self.decoded += 1
+		self.sink.write(basepath + '.png', b'PNG of ' + bytes(webpfile))
+
+class TestPageServer(TempDirTestCase):
+	def setUp(self):
+		TempDirTestCase.setUp(self)
+		self.writefile('src/100/chaporder.dat', chaporder(100, [201]))
+		self.archive = self.writefile('src/100/201.buka', makebuka(100, 201, [('0000.bup', bup(WEBP)), ('0001.jpg', JPG)]))
+		self.index = buka.PageIndex(':memory:')
+		self.index.update(os.path.join(self.tmp, 'src'))
+		self.man = MemoryMan()
+		self.server = buka.PageServer(('127.0.0.1', 0), self.index, self.man)
+		self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.thread.join()
+		self.server.server_close()
+		self.index.close()
+		TempDirTestCase.tearDown(self)
+
+	def get(self, path, headers={}):
+		conn = http.client.HTTPConnection(*self.server.server_address)
+		try:
+			conn.request('GET', path, headers=headers)
+			resp = conn.getresponse()
+			return resp.status, dict(resp.getheaders()), resp.read()
+		finally:
+			conn.close()
+
+	def test_listing(self):
+		status, headers, body = self.get('/100/')
+		self.assertEqual(status, 200)
+		self.assertEqual(json.loads(body.decode('utf-8')), [{'chapid': 201, 'name': '第001话'}])
+		self.assertEqual(self.get('/abc/')[0], 404)
+
+	def test_page(self):
+		status, headers, body = self.get('/100/201/0001.jpg')
+		self.assertEqual((status, headers['Content-Type'], body), (200, 'image/jpeg', JPG))
+		self.assertEqual(self.get('/100/201/0001.jpg', {'If-None-Match': headers['ETag']})[0], 304)
+		self.assertEqual(self.get('/100/201/0002.jpg')[0], 404)
+
+	def test_range(self):
+		status, headers, body = self.get('/100/201/0001.jpg', {'Range': 'bytes=2-5'})
+		self.assertEqual((status, body), (206, JPG[2:6]))
+		self.assertEqual(headers['Content-Range'], 'bytes 2-5/%d' % len(JPG))
+		status, headers, body = self.get('/100/201/0001.jpg', {'Range': 'bytes=1000-'})
+		self.assertEqual(status, 416)
+		self.assertEqual(headers['Content-Range'], 'bytes */%d' % len(JPG))
+
+	def test_decoded_once(self):
+		for i in range(2):
+			status, headers, body = self.get('/100/201/0000.bup')
+			self.assertEqual((status, headers['Content-Type'], body), (200, 'image/png', b'PNG of ' + WEBP))
+		self.assertEqual(self.man.decoded, 1)
+
+	def test_removed_archive(self):
+		os.remove(self.archive)
+		self.assertEqual(self.get('/100/201/0000.bup')[0], 404)
+		self.assertEqual(self.get('/100/201/0001.jpg')[0], 404)
+
+class TestPlanRename(TempDirTestCase):
+	def setUp(self):
+		TempDirTestCase.setUp(self)
+		for chapid in (201, 202, 203, 204):
+			os.makedirs(os.path.join(self.tmp, 'out', '100', str(chapid)))
+		os.makedirs(os.path.join(self.tmp, 'out', 'TestComic', '第004话'))
+		self.dm = buka.DirMan(os.path.join(self.tmp, 'out'))
+		nodes = self.dm.nodes
+		nodes[('out', '100')] = ('comic', 'TestComic')
+		nodes[('out', '100', '201')] = ('chap', 'TestComic', '第001话')
+		nodes[('out', '100', '202')] = ('chap', 'Other', '第002话')
+		# the same name twice
+		nodes[('out', '100', '203')] = ('chap', 'TestComic', '第001话')
+		nodes[('out', '100', '204')] = ('chap', 'TestComic', '第004话')
+		# not on disk
+		nodes[('out', '100', '205')] = ('chap', 'TestComic', '第005话')
+
+	def path(self, *parts):
+		return os.path.join(self.tmp, 'out', *parts)
+
+	def test_plan(self):
+		before = sorted(os.walk(self.path()))
+		plan, newparentpath = self.dm.planrename()
+		self.assertEqual(sorted(os.walk(self.path())), before)
+		self.assertEqual(newparentpath, self.path())
+		# deepest first, the comic merged into the existing folder
+		self.assertEqual(plan[-1], (self.path('100'), self.path('TestComic'), True))
+		self.assertEqual(sorted((src, dst) for src, dst, merge in plan[:-1]), [
+			(self.path('100', '201'), self.path('100', '第001话')),
+			(self.path('100', '202'), self.path('100', 'Other-第002话')),
+			(self.path('100', '203'), self.path('100', '第001话')),
+			(self.path('100', '204'), self.path('100', '第004话')),
+		])
+		merges = dict((os.path.basename(src), merge) for src, dst, merge in plan)
+		# only the second one to 第001话 merges
+		self.assertEqual(sorted([merges['201'], merges['203']]), [False, True])
+		self.assertFalse(merges['202'])
+		self.assertFalse(merges['204'])
+
+	def test_dryrun(self):
+		before = sorted(os.walk(self.path()))
+		out = io.StringIO()
+		with contextlib.redirect_stdout(out):
+			self.assertEqual(self.dm.renamedirs(dryrun=True), self.path())
+		self.assertEqual(sorted(os.walk(self.path())), before)
+		self.assertIn('%s -> %s (合并)' % (os.path.join('out', '100'), os.path.join('out', 'TestComic')), out.getvalue())
+
+	def test_renamedirs(self):
+		self.dm.renamedirs()
+		self.assertEqual(sorted(os.listdir(self.path())), ['TestComic'])
+		self.assertEqual(sorted(os.listdir(self.path('TestComic'))), ['Other-第002话', '第001话', '第004话'])
+
+class TestMmapSources(TempDirTestCase):
+	def test_removed_after_decoding(self):
+		self.writefile('src/100/chaporder.dat', chaporder(100, [201]))
+		self.writefile('src/100/201.buka', makebuka(100, 201, [('0000.bup', bup(WEBP))]))
+		target = os.path.join(self.tmp, 'out')
+		def onwait(man):
+			self.assertEqual([bytes(page) for basepath, page in man.pages], [WEBP])
+			archives = [name for root, dirs, files in os.walk(target) for name in files if name.endswith('.buka')]
+			self.assertEqual(archives, ['201.buka'])
+		man = RecordingMan(onwait)
+		args = argparse.Namespace(mmap=True, chapters=1, no_copy=False, process=1, clean=False, cbz=False)
+		buka.convertdir(os.path.join(self.tmp, 'src'), target, man, {}, args)
+		archives = [name for root, dirs, files in os.walk(target) for name in files if name.endswith('.buka')]
+		self.assertEqual(archives, [])
+		self.assertTrue(os.path.isfile(os.path.join(self.tmp, 'src', '100', '201.buka')))
+
+if __name__ == '__main__':
+	unittest.main()
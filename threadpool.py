@@ -38,6 +38,7 @@ __all__ = [
     'NoResultsPending',
     'NoWorkersAvailable',
     'ThreadPool',
+    'ByteBudget',
     'WorkRequest',
     'WorkerThread'
 ]
@@ -51,9 +52,11 @@ __license__ = "MIT license"
 
 # standard library modules
 import sys
+import time
 import threading
 import queue
 import traceback
+import functools
 from collections import deque
 from pprint import pprint
 
@@ -159,6 +162,8 @@ class WorkerThread(threading.Thread):
                 except:
                     request.exception = True
                     self._results_queue.put((request, sys.exc_info()))
+                # don't keep the arguments alive while waiting for the next one
+                request = result = None
 
     def dismiss(self):
         """Sets a flag to tell the thread to exit when done with current job."""
@@ -288,13 +293,22 @@ class ThreadPool:
             worker.join()
         self.dismissedWorkers = []
 
+    def queueSize(self):
+        """Return the approximate number of requests waiting for a worker."""
+        return self._requests_queue.qsize()
+
     def putRequest(self, request, block=True, timeout=None):
         """Put work request into work queue and save its id for later."""
         assert isinstance(request, WorkRequest)
         # don't reuse old work requests
         assert not getattr(request, 'exception', None)
-        self._requests_queue.put(request, block, timeout)
+        # register first: another thread may poll the result right away
         self.workRequests[request.requestID] = request
+        try:
+            self._requests_queue.put(request, block, timeout)
+        except queue.Full:
+            del self.workRequests[request.requestID]
+            raise
 
     def poll(self, block=False):
         """Process any new results in the queue."""
@@ -327,26 +341,110 @@ class ThreadPool:
             except NoResultsPending:
                 break
 
+class ByteBudget:
+    """Limit the total size of the requests queued or running.
+
+    ``acquire`` blocks until ``size`` more bytes fit in ``max_bytes``,
+    or raises ``queue.Full`` as ``Queue.put`` does when ``block`` is false
+    or ``timeout`` runs out. A request larger than the whole budget is let
+    through when nothing else is in flight.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size, block=True, timeout=None):
+        with self._cond:
+            if not block:
+                if self.in_flight and self.in_flight + size > self.max_bytes:
+                    raise queue.Full
+            elif timeout is None:
+                while self.in_flight and self.in_flight + size > self.max_bytes:
+                    self._cond.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.monotonic() + timeout
+                while self.in_flight and self.in_flight + size > self.max_bytes:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Full
+                    self._cond.wait(remaining)
+            self.in_flight += size
+
+    def release(self, size):
+        with self._cond:
+            self.in_flight -= size
+            self._cond.notify_all()
+
+
+def _makeCallable(callable_, budget, sizeof, args, kwargs):
+    """Return the callable of a request, releasing its bytes when done,
+    and the size acquired from the budget.
+
+    ``block_`` and ``timeout_`` are passed to the budget, not to ``sizeof``.
+
+    """
+    if budget is None:
+        return callable_, 0
+    sizekwargs = dict(kwargs)
+    block = sizekwargs.pop('block_', True)
+    timeout = sizekwargs.pop('timeout_', None)
+    size = sizeof(*args, **sizekwargs)
+    budget.acquire(size, block, timeout)
+    return functools.partial(_callReleasing, callable_, budget, size), size
+
+def _callReleasing(callable_, budget, size, *args, **kwds):
+    try:
+        return callable_(*args, **kwds)
+    finally:
+        budget.release(size)
+
+
 class OrderedRequestManager:
-    """Make the results arrive in FIFO order."""
+    """Make the results arrive in FIFO order.
+
+    If ``max_bytes > 0``, ``putRequest`` blocks on the total size of the
+    requests in flight instead of their count; ``sizeof`` is called with
+    the arguments of ``putRequest`` and returns the size of a request.
+
+    ``putRequest`` and ``wait`` may be called from several threads; the
+    submission and the polling of the results are serialized by a lock.
+
+    """
     def __init__(self, num_workers, callable_, callback=None,
-        exc_callback=_handle_thread_exception, q_size=0, resq_size=0, poll_timeout=5):
+        exc_callback=_handle_thread_exception, q_size=0, resq_size=0, poll_timeout=5,
+        max_bytes=0, sizeof=None):
         self.pool = ThreadPool(num_workers, q_size=q_size, resq_size=resq_size, poll_timeout=poll_timeout)
         self.requests = deque()
         self.results = {}
         self.callable_ = callable_
         self.callback = callback
         self.exc_callback = exc_callback
+        self.budget = ByteBudget(max_bytes) if max_bytes > 0 else None
+        self.sizeof = sizeof
+        self._lock = threading.RLock()
 
     def putRequest(self, *args, **kwargs):
-        request = WorkRequest(self.callable_, args, kwargs, callback=self._handle_result,
+        callable_, size = _makeCallable(self.callable_, self.budget, self.sizeof, args, kwargs)
+        request = WorkRequest(callable_, args, kwargs, callback=self._handle_result,
                     exc_callback=self.exc_callback)
-        self.requests.append(request)
-        self.pool.putRequest(request, block=kwargs.get('block_', True), timeout=kwargs.get('timeout_', None))
-        try:
-            self.pool.poll()
-        except NoResultsPending:
-            pass
+        with self._lock:
+            self.requests.append(request)
+            try:
+                self.pool.putRequest(request, block=kwargs.get('block_', True), timeout=kwargs.get('timeout_', None))
+            except queue.Full:
+                self.requests.pop()
+                if self.budget:
+                    self.budget.release(size)
+                raise
+            try:
+                self.pool.poll()
+            except NoResultsPending:
+                pass
 
     def _handle_result(self, request, result):
         self.results[request.requestID] = result
@@ -359,48 +457,66 @@ class OrderedRequestManager:
     def map(self, iterable):
         for item in iterable:
             self.putRequest(item)
-        self.pool.poll()
+        with self._lock:
+            self.pool.poll()
 
     def wait(self):
-        while 1:
-            try:
-                self.pool.poll(True)
-            except NoResultsPending:
-                break
-        while self.requests:
-            resultarrived = self.requests.popleft()
-            if self.callback:
-                self.callback(resultarrived, self.results.pop(resultarrived.requestID))
+        with self._lock:
+            while 1:
+                try:
+                    self.pool.poll(True)
+                except NoResultsPending:
+                    break
+            while self.requests:
+                resultarrived = self.requests.popleft()
+                if self.callback:
+                    self.callback(resultarrived, self.results.pop(resultarrived.requestID))
 
 
 class NoOrderedRequestManager:
-    """Make the results arrive not in order."""
+    """Make the results arrive not in order.
+
+    ``max_bytes``, ``sizeof`` and the lock work as in ``OrderedRequestManager``.
+
+    """
     def __init__(self, num_workers, callable_, callback=None,
-        exc_callback=_handle_thread_exception, q_size=0, resq_size=0, poll_timeout=5):
+        exc_callback=_handle_thread_exception, q_size=0, resq_size=0, poll_timeout=5,
+        max_bytes=0, sizeof=None):
         self.pool = ThreadPool(num_workers, q_size=q_size, resq_size=resq_size, poll_timeout=poll_timeout)
         self.callable_ = callable_
         self.callback = callback
         self.exc_callback = exc_callback
+        self.budget = ByteBudget(max_bytes) if max_bytes > 0 else None
+        self.sizeof = sizeof
+        self._lock = threading.RLock()
 
     def putRequest(self, *args, **kwargs):
-        request = WorkRequest(self.callable_, args, kwargs, callback=self.callback,
+        callable_, size = _makeCallable(self.callable_, self.budget, self.sizeof, args, kwargs)
+        request = WorkRequest(callable_, args, kwargs, callback=self.callback,
                     exc_callback=self.exc_callback)
-        self.pool.putRequest(request, block=kwargs.get('block_', True), timeout=kwargs.get('timeout_', None))
-        try:
-            self.pool.poll()
-        except NoResultsPending:
-            pass
+        with self._lock:
+            try:
+                self.pool.putRequest(request, block=kwargs.get('block_', True), timeout=kwargs.get('timeout_', None))
+            except queue.Full:
+                if self.budget:
+                    self.budget.release(size)
+                raise
+            try:
+                self.pool.poll()
+            except NoResultsPending:
+                pass
 
     def map(self, iterable):
         for item in iterable:
             self.putRequest(item)
 
     def wait(self):
-        while 1:
-            try:
-                self.pool.poll(True)
-            except NoResultsPending:
-                break
+        with self._lock:
+            while 1:
+                try:
+                    self.pool.poll(True)
+                except NoResultsPending:
+                    break
 
 
 ################